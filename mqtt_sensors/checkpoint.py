@@ -0,0 +1,37 @@
+#
+# Progress of long-running copies, kept in a JSON file
+#
+
+import json
+import logging
+import os
+import threading
+from typing import Dict, Optional
+
+log = logging.getLogger('checkpoint')
+
+
+class Checkpoint:
+    """Progress of each series, saved to a JSON file after every change so that an interrupted
+    or repeated run can carry on where the last one stopped"""
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.lock = threading.Lock()
+        self.done: Dict[str, int] = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                self.done = json.load(f)
+            log.info(f'Resuming from {path}')
+
+    def get(self, key: str) -> Optional[int]:
+        with self.lock:
+            return self.done.get(key)
+
+    def set(self, key: str, timestamp: int):
+        with self.lock:
+            self.done[key] = timestamp
+            if self.path is None:
+                return
+            with open(f'{self.path}.tmp', 'w') as f:
+                json.dump(self.done, f)
+            os.replace(f'{self.path}.tmp', self.path)
@@ -0,0 +1,44 @@
+import math
+import time
+from typing import Dict, Optional, Tuple
+
+
+class Deadband:
+    """Suppress readings that have not moved more than a threshold since the last published
+    reading, but let one through every heartbeat interval regardless"""
+    def __init__(self, threshold: Optional[float], heartbeat: float):
+        self.threshold = threshold
+        self.heartbeat = heartbeat
+        self.last: Dict[str, Tuple[Tuple[float, ...], float]] = {}
+
+    def changed(self, a: float, b: float) -> bool:
+        if math.isnan(a) or math.isnan(b):
+            return math.isnan(a) != math.isnan(b)
+        return abs(a - b) > self.threshold
+
+    def check(self, key: str, *values: float) -> bool:
+        """Return True if the values for key should be published"""
+        if self.threshold is None:
+            return True
+        now = time.monotonic()
+        last = self.last.get(key)
+        if last is not None:
+            last_values, last_time = last
+            if now < last_time + self.heartbeat and \
+                    not any(map(self.changed, values, last_values)):
+                return False
+        self.last[key] = (values, now)
+        return True
+
+    @staticmethod
+    def add_args(parser):
+        parser_deadband = parser.add_argument_group("Deadband")
+        parser_deadband.add_argument("--deadband", metavar="DELTA", type=float,
+                                     help="Only publish a reading when it has moved more than DELTA "
+                                     "since the last published one")
+        parser_deadband.add_argument("--heartbeat", metavar="SEC", type=float, default=600,
+                                     help="Publish unchanged readings at least this often [seconds]")
+
+    @staticmethod
+    def from_args(args):
+        return Deadband(args.deadband, args.heartbeat)
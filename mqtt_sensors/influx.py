@@ -0,0 +1,42 @@
+#
+# Writing to the InfluxDB v2 HTTP API, in line protocol
+#
+
+import gzip
+import logging
+import urllib.request
+from typing import Iterable
+from urllib.parse import urlencode
+
+log = logging.getLogger('influx')
+
+
+def escape(name: str) -> str:
+    """Escape a measurement, tag or field name, or a tag value"""
+    return name.replace('\\', '\\\\').replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
+
+def sample_line(series_name: str, timestamp: int, value: float) -> str:
+    """A sample as a line, with the series as both the field name and a tag"""
+    name = escape(series_name)
+    return f'sample,series={name} {name}={value!r} {timestamp}'
+
+
+class InfluxWriter:
+    """Posts batches of lines, with timestamps in seconds, to the write endpoint of a bucket"""
+    def __init__(self, url: str, org: str, bucket: str, token: str, timeout: float = 30):
+        self.url = f'{url.rstrip("/")}/api/v2/write?' + \
+            urlencode({'org': org, 'bucket': bucket, 'precision': 's'})
+        self.headers = {
+            'Authorization': f'Token {token}',
+            'Content-Type': 'text/plain; charset=utf-8',
+            'Content-Encoding': 'gzip',
+        }
+        self.timeout = timeout
+
+    def write(self, lines: Iterable[str]):
+        """Raises urllib.error.URLError (or its subclass HTTPError) if the write fails"""
+        body = gzip.compress('\n'.join(lines).encode(), compresslevel=1)
+        request = urllib.request.Request(self.url, data=body, headers=self.headers, method='POST')
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
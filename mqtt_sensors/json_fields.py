@@ -0,0 +1,48 @@
+import argparse
+import sys
+from typing import Dict, List, Tuple
+
+# Fields stored from JSON messages, and the suffix added to the node name for their series
+JSON_FIELDS: Dict[str, str] = {
+    'temperature': 't',
+    'humidity': 'rh',
+    'pressure': 'p',
+    'linkquality': 'link',
+    'voltage': 'v',
+}
+
+
+def parse_field(value: str) -> Tuple[str, str]:
+    name, _, suffix = value.partition('=')
+    if not name or not suffix:
+        raise argparse.ArgumentTypeError(f'Expected NAME=SUFFIX, got {value}')
+    return name, suffix
+
+
+class JsonFields:
+    """The fields taken from JSON messages. The list of fields and series names is built
+    once per node, with interned names that are cheap to look up."""
+    def __init__(self, fields: Dict[str, str] = JSON_FIELDS):
+        self.fields = list(fields.items())
+        self.nodes: Dict[str, List[Tuple[str, str]]] = {}
+
+    def series(self, node_name: str) -> List[Tuple[str, str]]:
+        series = self.nodes.get(node_name)
+        if series is None:
+            series = [(field, sys.intern(f'{node_name}-{suffix}')) for field, suffix in self.fields]
+            self.nodes[node_name] = series
+        return series
+
+    def values(self, node_name: str, content: dict) -> List[Tuple[str, float]]:
+        """The series names and values of the fields present in a message"""
+        return [(source_name, float(content[field])) for field, source_name in self.series(node_name)
+                if content.get(field) is not None]
+
+    @staticmethod
+    def add_args(parser):
+        parser.add_argument("--field", metavar="NAME=SUFFIX", type=parse_field, action="append", default=[],
+                            help="Also store field NAME of JSON messages, as series <node>-SUFFIX")
+
+    @staticmethod
+    def from_args(args):
+        return JsonFields({**JSON_FIELDS, **dict(args.field)})
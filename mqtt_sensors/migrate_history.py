@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+#
+# Copy sample history between the SQLite database of mqtt_to_sql and the RRDs of mqtt_to_rrd
+#
+
+import argparse
+import logging
+import math
+import re
+import shlex
+import sqlite3
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from . import mqtt_to_rrd, sample_db
+from .checkpoint import Checkpoint
+from .json_fields import JSON_FIELDS
+from .mqtt_to_rrd import DATA_SOURCES, create_rrd, read_info
+from .rrd_backend import RrdError, RrdPipe
+
+# Time span read and written at a time, which bounds the memory use
+CHUNK_SPAN = 7*24*60*60
+# Values per rrdtool update command
+UPDATE_BATCH = 1000
+# Resolution fetched from RRDs, the step used by mqtt_to_rrd
+RRD_STEP = 60
+# Series name suffix used by mqtt_to_sql for each data source of mqtt_to_rrd
+DS_SUFFIXES: Dict[str, str] = {ds: JSON_FIELDS[field] for field, ds in mqtt_to_rrd.JSON_FIELDS.items()
+                               if field in JSON_FIELDS}
+
+log = logging.getLogger("migrate_history")
+
+
+def chunks(start_time: int, end_time: int) -> Iterator[Tuple[int, int]]:
+    """Split a time range into (start, end) chunks, end exclusive"""
+    for chunk_start in range(start_time, end_time, CHUNK_SPAN):
+        yield chunk_start, min(chunk_start + CHUNK_SPAN, end_time)
+
+
+def rrd_source(series_name: str) -> Tuple[str, str]:
+    """The RRD file name (without .rrd) and data source that mqtt_to_rrd stores a series in.
+    Fields of JSON messages, which mqtt_to_sql stores as <device>-<suffix>, are data sources
+    in one RRD per device."""
+    for ds, suffix in DS_SUFFIXES.items():
+        if series_name.endswith(f'-{suffix}'):
+            return series_name[:-len(suffix) - 1], ds
+    return series_name, 'value'
+
+
+def sql_to_rrd(db: sqlite3.Connection, backend: RrdPipe, rrd_path: str, checkpoint: Checkpoint,
+               name: str, series: Dict[str, int], start_time: Optional[int], end_time: int):
+    """Append the samples of the series stored in one RRD, by data source, that are newer than
+    the last update of the RRD"""
+    key = f'sql-to-rrd/{name}'
+    first_times = [sample_db.first_time(db, series_id) for series_id in series.values()]
+    first_times = [t for t in first_times if t is not None]
+    if not first_times:
+        return
+    rrdfile = str(Path(rrd_path, f'{name}.rrd'))
+    start_time = max(min(first_times), start_time or 0, checkpoint.get(key) or 0)
+    if Path(rrdfile).is_file():
+        rrd = read_info(backend, rrdfile)
+        start_time = max(start_time, rrd.last_update + 1)
+        for ds in series:
+            if ds not in rrd.data_sources:
+                log.info(f'Adding DS {ds} to {rrdfile}')
+                backend.run('tune', rrdfile, f'DS:{ds}:{DATA_SOURCES[ds]}')
+                rrd.data_sources.append(ds)
+        data_sources = rrd.data_sources
+        last_update = rrd.last_update
+    else:
+        last_update = start_time - 1
+        data_sources = [ds for ds in DATA_SOURCES if ds in series]
+        create_rrd(backend, rrdfile, data_sources=data_sources, start=last_update)
+    count = 0
+    for chunk_start, chunk_end in chunks(start_time, end_time):
+        columns = {ds: sample_db.read_range(db, series_id, chunk_start, chunk_end - 1)
+                   for ds, series_id in series.items()}
+        # The fields of a message share a timestamp, and are written in the same update. The
+        # same time can also show up both in the main database and in a partition.
+        times = np.unique(np.concatenate([t for t, _ in columns.values()]))
+        times = times[times > last_update]
+        values = []
+        for ds in data_sources:
+            column = np.full(len(times), np.nan)
+            if ds in columns:
+                ds_times, ds_values = columns[ds]
+                new = ds_times > last_update
+                column[np.searchsorted(times, ds_times[new])] = ds_values[new]
+            values.append(column.tolist())
+        args = [':'.join([str(t)] + ['U' if math.isnan(v) else repr(v) for v in row])
+                for t, *row in zip(times.tolist(), *values)]
+        for i in range(0, len(args), UPDATE_BATCH):
+            backend.run('update', rrdfile, *args[i:i + UPDATE_BATCH])
+        if len(times):
+            last_update = int(times[-1])
+        count += len(times)
+        checkpoint.set(key, chunk_end)
+    log.info(f'{name}: {count} updates of {", ".join(series)} written to {rrdfile}')
+
+
+def fetch(backend: RrdPipe, rrdfile: str, start_time: int, end_time: int) -> Tuple[List[str], List[str]]:
+    """Fetch average values from an RRD. Returns the DS names and the data lines."""
+    output = backend.run('fetch', rrdfile, 'AVERAGE', '-r', str(RRD_STEP),
+                         '-s', str(start_time), '-e', str(end_time))
+    return output[0].split(), [line for line in output[1:] if ':' in line]
+
+
+def rrd_first(backend: RrdPipe, rrdfile: str) -> int:
+    """The start of the RRA reaching furthest back"""
+    rras = set()
+    for line in backend.run('info', rrdfile):
+        match = re.match(r'rra\[(\d+)\]\.', line)
+        if match:
+            rras.add(match.group(1))
+    return min(int(backend.run('first', rrdfile, '--rraindex', rra)[0]) for rra in rras)
+
+
+def rrd_to_sql(db: sqlite3.Connection, backend: RrdPipe, checkpoint: Checkpoint, rrdfile: Path,
+               start_time: Optional[int], end_time: int):
+    """Add RRD values to the database, for the times where the series has no samples. Data sources
+    other than 'value' go to series named <file>-<suffix>, like mqtt_to_sql names them."""
+    key = f'rrd-to-sql/{rrdfile.stem}'
+    start_time = max(rrd_first(backend, str(rrdfile)), start_time or 0, checkpoint.get(key) or 0)
+    series_ids: Dict[str, int] = {}
+    count = 0
+    for chunk_start, chunk_end in chunks(start_time, end_time):
+        data_sources, lines = fetch(backend, str(rrdfile), chunk_start, chunk_end)
+        rows = np.array([[float(v) for v in line.split(':')[1].split()] for line in lines]).reshape(-1, len(data_sources))
+        times = np.array([int(line.split(':')[0]) for line in lines], dtype=np.int64)
+        in_chunk = (times > chunk_start) & (times <= chunk_end)
+        for index, ds in enumerate(data_sources):
+            name = rrdfile.stem if ds == 'value' else f'{rrdfile.stem}-{DS_SUFFIXES.get(ds, ds)}'
+            series_id = series_ids.get(name)
+            if series_id is None:
+                db.execute('INSERT OR IGNORE INTO series (name) VALUES (?)', (name, ))
+                series_id = db.execute('SELECT id FROM series WHERE name=?', (name, )).fetchone()[0]
+                series_ids[name] = series_id
+            values = rows[:, index]
+            present = in_chunk & ~np.isnan(values)
+            # Skip the steps that already have samples
+            existing, _ = sample_db.read_range(db, series_id, chunk_start - RRD_STEP, chunk_end)
+            after = np.searchsorted(existing, times - RRD_STEP, side='right')
+            covered = np.zeros(len(times), dtype=bool)
+            found = after < len(existing)
+            covered[found] = existing[after[found]] <= times[found]
+            samples = [(t, series_id, v) for t, v in
+                       zip(times[present & ~covered].tolist(), values[present & ~covered].tolist())]
+            samples = sample_db.insert_samples(db, samples, replace=False)
+            sample_db.update_rollups(db, samples)
+            count += len(samples)
+        db.commit()
+        checkpoint.set(key, chunk_end)
+    log.info(f'{rrdfile}: {count} samples added to the database')
+
+
+def parse_time(value: str) -> int:
+    """A Unix time or an ISO 8601 date"""
+    if value.isdigit():
+        return int(value)
+    return int(time.mktime(time.strptime(value, '%Y-%m-%d')))
+
+
+def run():
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Copy sample history between SQLite and RRD")
+    parser.add_argument("direction", choices=("sql-to-rrd", "rrd-to-sql"))
+    parser.add_argument("--db", metavar="FILE", default="samples.sqlite", help="SQLite database file")
+    parser.add_argument("--rrd-path", metavar="PATH", default=".",
+                        help="Path to directory with RRD files")
+    parser.add_argument("--series", metavar="NAME", action="append",
+                        help="Series, or RRD file, to copy (can be repeated, default all)")
+    parser.add_argument("--start", metavar="TIME", type=parse_time,
+                        help="Copy samples from this time (YYYY-MM-DD or Unix time)")
+    parser.add_argument("--checkpoint", metavar="FILE",
+                        help="Record progress in FILE, and resume from it")
+    parser.add_argument("--rrdtool", metavar="CMD", default="rrdtool",
+                        help="rrdtool command, kept running in pipe mode as 'CMD -'")
+    parser.add_argument("--debug", default=False, action="store_true",
+                        help="Enable debug printouts")
+    args = parser.parse_args()
+
+    if args.debug:
+        logging.getLogger().setLevel('DEBUG')
+
+    # Give a running mqtt_to_sql time to finish its commits
+    db = sqlite3.connect(args.db, timeout=60)
+    sample_db.create_schema(db)
+    backend = RrdPipe(shlex.split(args.rrdtool), log)
+    checkpoint = Checkpoint(args.checkpoint)
+    end_time = int(time.time())
+    start = time.monotonic()
+    try:
+        if args.direction == "sql-to-rrd":
+            rrds: Dict[str, Dict[str, int]] = {}
+            for name, series_id in db.execute('SELECT name, id FROM series ORDER BY name').fetchall():
+                rrd_name, ds = rrd_source(name)
+                if args.series is None or name in args.series or rrd_name in args.series:
+                    rrds.setdefault(rrd_name, {})[ds] = series_id
+            for rrd_name, series in rrds.items():
+                sql_to_rrd(db, backend, args.rrd_path, checkpoint, rrd_name, series, args.start, end_time)
+        else:
+            for rrdfile in sorted(Path(args.rrd_path).glob('*.rrd')):
+                if args.series is None or rrdfile.stem in args.series:
+                    rrd_to_sql(db, backend, checkpoint, rrdfile, args.start, end_time)
+    except RrdError as e:
+        log.error(f'rrdtool failed: {e}')
+    finally:
+        backend.stop()
+        db.close()
+    log.info(f'Done in {time.monotonic() - start:.1f} s')
+
+
+if __name__ == '__main__':
+    run()
@@ -4,20 +4,80 @@
 #
 
 import argparse
+import json
 import logging
 import platform
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import time
+from typing import Callable, Dict, List, Optional
 
+from .deadband import Deadband
 from .mqtt_connection import MqttConnection
 
 TOPIC = "temperature/%s"
+BATCH_TOPIC = "temperature-batch/%s"
 W1_PATH = "/sys/bus/w1/devices/"
+# Maximum time to wait for a bulk conversion on all buses
+BULK_READ_TIMEOUT = 2.0
+# Resolutions supported by the DS18B20 and friends
+RESOLUTIONS = range(9, 13)
+
+w1_path = W1_PATH
 
 log = logging.getLogger("mqtt_1w")
 
 
-def sample_loop(sample_interval, mqtt_connection: MqttConnection):
+class Sensor:
+    __slots__ = ("name", "path", "last_value", "last_time", "reads", "errors")
+
+    def __init__(self, path: Path):
+        self.name = path.parts[-2]
+        self.path = path
+        self.last_value: Optional[float] = None
+        self.last_time: Optional[float] = None
+        self.reads = 0
+        self.errors = 0
+
+    def update(self, value: float):
+        self.last_value = value
+        self.last_time = time.time()
+        self.reads += 1
+
+
+class SensorRegistry:
+    """Sensors found on the one-wire buses, rescanned now and then instead of on every sample"""
+    def __init__(self, rescan_interval: float, on_added: Callable[[Sensor], None] = None):
+        self.sensors: Dict[str, Sensor] = {}
+        self.rescan_interval = rescan_interval
+        self.on_added = on_added
+        self.next_scan = 0.0
+
+    def scan(self):
+        log.debug("Scanning for one-wire sensors")
+        found = {s_path.parts[-2]: s_path for s_path in Path(w1_path).glob("*/w1_slave")}
+        for sensor_name in self.sensors.keys() - found.keys():
+            sensor = self.sensors.pop(sensor_name)
+            log.info("Sensor %s removed after %d reads, %d errors" % (sensor_name, sensor.reads, sensor.errors))
+        for sensor_name in found.keys() - self.sensors.keys():
+            log.info("Sensor %s added" % sensor_name)
+            sensor = Sensor(found[sensor_name])
+            self.sensors[sensor_name] = sensor
+            if self.on_added is not None:
+                self.on_added(sensor)
+        self.next_scan = time.monotonic() + self.rescan_interval
+
+    def request_scan(self):
+        self.next_scan = 0.0
+
+    def get_sensors(self) -> List[Sensor]:
+        if time.monotonic() >= self.next_scan:
+            self.scan()
+        return list(self.sensors.values())
+
+
+def sample_loop(sample_interval, mqtt_connection: MqttConnection, registry: SensorRegistry,
+                executor: ThreadPoolExecutor, deadband: Deadband, bulk=False, batch_topic=None):
     last_time = time.monotonic() - sample_interval
     while True:
         try:
@@ -26,7 +86,10 @@ def sample_loop(sample_interval, mqtt_connection: MqttConnection):
             pass
 
         last_time = time.monotonic()
-        sample_onewire(mqtt_connection)
+        sample_onewire(mqtt_connection, registry, executor, deadband, bulk, batch_topic)
+        elapsed = time.monotonic() - last_time
+        if elapsed > sample_interval:
+            log.warning("Sampling took %.3f s, longer than the %d s interval" % (elapsed, sample_interval))
 
 
 def parse(lines):
@@ -43,19 +106,109 @@ def parse(lines):
         raise RuntimeError("Unable to parse")
 
 
-def sample_onewire(mqtt_connection: MqttConnection):
+def parse_temperature(text):
+    """Parse the millidegree value in a w1_therm 'temperature' attribute"""
+    try:
+        t = float(text) / 1000.0
+    except ValueError:
+        raise RuntimeError("Unable to parse")
+    if t == 85.000:
+        raise RuntimeError("Missing temperature reading")
+    return t
+
+
+def bulk_convert():
+    """Start a conversion on all sensors on all buses at once, and wait for it to finish"""
+    masters = list(Path(w1_path).glob("w1_bus_master*/therm_bulk_read"))
+    for m_path in masters:
+        m_path.write_text("trigger\n")
+    deadline = time.monotonic() + BULK_READ_TIMEOUT
+    for m_path in masters:
+        # -1 means that a conversion is still in progress
+        while m_path.read_text().strip() == "-1":
+            if time.monotonic() > deadline:
+                raise RuntimeError("Bulk conversion timed out on %s" % m_path.parts[-2])
+            time.sleep(0.05)
+
+
+def read_sensor(s_path: Path, bulk=False):
+    log.debug("Reading sensor %s" % s_path.parts[-2])
+    if bulk:
+        # After a bulk conversion the result can be read without starting a new one
+        return parse_temperature(s_path.with_name("temperature").read_text())
+    return parse(s_path.read_text().splitlines())
+
+
+def parse_sensor_settings(values: Optional[List[str]]) -> Dict[Optional[str], int]:
+    """Parse repeated [SENSOR=]VALUE options. The None key holds the default for all sensors."""
+    settings = {}
+    for value in values or []:
+        sensor_name, _, setting = value.rpartition("=")
+        settings[sensor_name or None] = int(setting)
+    return settings
+
+
+def write_sensor_attribute(s_dir: Path, name: str, value: int):
+    try:
+        (s_dir / name).write_text("%d\n" % value)
+        log.info("Sensor %s: %s = %s" % (s_dir.name, name, (s_dir / name).read_text().strip()))
+    except IOError as e:
+        log.warning("Unable to set %s on sensor %s: %s" % (name, s_dir.name, e))
+
+
+def configure_sensor(sensor: Sensor, resolutions: Dict[Optional[str], int],
+                     conv_times: Dict[Optional[str], int]):
+    """Apply resolution and conversion time settings through the w1_therm sysfs attributes"""
+    s_dir = sensor.path.parent
+    resolution = resolutions.get(sensor.name, resolutions.get(None))
+    if resolution is not None:
+        write_sensor_attribute(s_dir, "resolution", resolution)
+    # conv_time must be written after resolution, which resets it to the default
+    conv_time = conv_times.get(sensor.name, conv_times.get(None))
+    if conv_time is not None:
+        write_sensor_attribute(s_dir, "conv_time", conv_time)
+
+
+def sample_onewire(mqtt_connection: MqttConnection, registry: SensorRegistry,
+                   executor: ThreadPoolExecutor, deadband: Deadband, bulk=False, batch_topic=None):
     log.debug("Sampling one-wire sensors")
+    start_time = time.monotonic()
+    timestamp = int(time.time())
+    readings: Dict[str, float] = {}
 
-    for s_path in Path(W1_PATH).glob("*/w1_slave"):
-        sensor_name = s_path.parts[-2]
-        log.debug("Reading sensor %s" % sensor_name)
+    if bulk:
         try:
-            text = s_path.read_text()
-            temperature = parse(text.splitlines())
-            log.debug("Sensor %s = %.3f C" % (sensor_name, temperature))
-            mqtt_connection.publish(TOPIC % sensor_name, str(temperature))
+            bulk_convert()
         except (IOError, RuntimeError) as e:
-            log.warning(e)
+            log.warning("Bulk conversion failed, reading sensors one by one: %s" % e)
+            bulk = False
+
+    # Each read blocks for the whole conversion time, so run them concurrently
+    futures = [(sensor, executor.submit(read_sensor, sensor.path, bulk))
+               for sensor in registry.get_sensors()]
+    for sensor, future in futures:
+        try:
+            temperature = future.result()
+            sensor.update(temperature)
+            log.debug("Sensor %s = %.3f C" % (sensor.name, temperature))
+            if not deadband.check(sensor.name, temperature):
+                log.debug("Suppressing unchanged reading")
+            elif batch_topic is not None:
+                readings[sensor.name] = temperature
+            else:
+                mqtt_connection.publish(TOPIC % sensor.name, str(temperature))
+        except (IOError, RuntimeError) as e:
+            sensor.errors += 1
+            log.warning("Sensor %s: %s (%d errors)" % (sensor.name, e, sensor.errors))
+            # The sensor may have been disconnected, or a new one attached
+            registry.request_scan()
+
+    if readings:
+        # One document for all sensors, sharing the timestamp of the cycle
+        doc = json.dumps({"time": timestamp, "temperature": readings}, separators=(",", ":"))
+        mqtt_connection.publish(batch_topic, doc)
+
+    log.debug("Sampled %d sensors in %.3f s" % (len(futures), time.monotonic() - start_time))
 
 
 def run():
@@ -66,20 +219,56 @@ def run():
                         help="Sample interval [seconds]")
     parser.add_argument("--debug", default=False, action="store_true",
                         help="Enable debug printouts")
+    parser.add_argument("--workers", metavar="N", default=1, type=int,
+                        help="Number of sensors read at once")
+    parser.add_argument("--bulk-read", default=False, action="store_true",
+                        help="Start the conversion on all sensors at once with therm_bulk_read")
+    parser.add_argument("--batch", default=False, action="store_true",
+                        help="Publish all readings from a cycle as one JSON document on %s"
+                        % (BATCH_TOPIC % "<hostname>"))
+    parser.add_argument("--rescan", metavar="SEC", default=600, type=int,
+                        help="Interval between scans for added or removed sensors [seconds]")
+    parser.add_argument("--w1-path", metavar="PATH", default=W1_PATH,
+                        help="Path to one-wire devices in sysfs")
+    parser_w1 = parser.add_argument_group("Sensor configuration")
+    parser_w1.add_argument("--resolution", metavar="[SENSOR=]BITS", action="append",
+                           help="Conversion resolution, 9-12 bits, for all sensors or "
+                           "for one sensor (can be repeated)")
+    parser_w1.add_argument("--conv-time", metavar="[SENSOR=]MS", action="append",
+                           help="Conversion time in ms for all sensors or for one sensor, "
+                           "0 for the default and 1 to measure it (can be repeated)")
+    Deadband.add_args(parser)
     MqttConnection.add_args(parser)
     args = parser.parse_args()
     
     if args.debug:
         logging.getLogger().setLevel('DEBUG')
 
+    try:
+        resolutions = parse_sensor_settings(args.resolution)
+        conv_times = parse_sensor_settings(args.conv_time)
+    except ValueError as e:
+        parser.error(str(e))
+    if any(r not in RESOLUTIONS for r in resolutions.values()):
+        parser.error("Resolution must be between %d and %d bits" % (RESOLUTIONS[0], RESOLUTIONS[-1]))
+
+    global w1_path
+    w1_path = args.w1_path
+    registry = SensorRegistry(args.rescan,
+                              lambda sensor: configure_sensor(sensor, resolutions, conv_times))
+
     mqtt_connection = MqttConnection(f'1w-{platform.node()}', args, log)
+    executor = ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix="w1")
 
     try:
         mqtt_connection.start()
-        sample_loop(args.time, mqtt_connection)
+        batch_topic = BATCH_TOPIC % platform.node() if args.batch else None
+        sample_loop(args.time, mqtt_connection, registry, executor, Deadband.from_args(args),
+                    args.bulk_read, batch_topic)
     except KeyboardInterrupt:
         log.info('Exit on CTRL-C')
     finally:
+        executor.shutdown(wait=False)
         mqtt_connection.stop()
 
 
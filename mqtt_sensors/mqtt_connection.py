@@ -1,8 +1,34 @@
+import json
 import logging
+import threading
+import time
+from typing import Callable, Dict, Optional, Set, Tuple
 import paho.mqtt.client as mqtt
 
+from .outbox import Outbox
+from .topic_trie import TopicTrie
 
-class MqttConnection:
+# Time to wait for a replayed message to be sent before giving up on the replay
+REPLAY_TIMEOUT = 30
+# Interval between publish statistics in the debug log
+STATS_INTERVAL = 60
+
+
+def timestamped(payload: str, timestamp: float) -> str:
+    """Attach a sample time to a payload, for messages that are published late.
+    JSON objects get a "time" field, other payloads are wrapped as {"time": ..., "value": ...}."""
+    try:
+        content = json.loads(payload)
+    except ValueError:
+        content = payload
+    if not isinstance(content, dict):
+        content = {'value': content}
+    content.setdefault('time', int(timestamp))
+    return json.dumps(content, separators=(',', ':'))
+
+
+class MqttClient:
+    """Broker connection with the options and state topic shared by all scripts"""
     def __init__(self, client_id: str, args, log=logging.getLogger()):
         self.log = log.getChild('mqtt-connection')
         self.client = mqtt.Client(client_id=client_id)
@@ -13,6 +39,7 @@ class MqttConnection:
             self.client.tls_insecure_set(args.tls_insecure)
             port = 8883
         self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
         if args.username:
             self.client.username_pw_set(args.username, args.password)
 
@@ -23,14 +50,14 @@ class MqttConnection:
     def start(self):
         self.client.loop_start()
 
+    def loop_forever(self):
+        self.client.loop_forever()
+
     def stop(self):
         self.client.publish(self.state_topic, 'disconnected')
         self.client.loop_stop()
         self.client.disconnect()
 
-    def publish(self, topic: str, data: str):
-        self.client.publish(topic, data)
-
     def on_connect(self, mqtt_client, userdata, flags, rc):
         if rc == 0:
             self.log.info(f'Connected')
@@ -38,6 +65,10 @@ class MqttConnection:
         else:
             self.log.warning(f'Connection failed: {mqtt.connack_string(rc)}')
 
+    def on_disconnect(self, mqtt_client, userdata, rc):
+        if rc != 0:
+            self.log.warning(f'Disconnected: {mqtt.error_string(rc)}')
+
     @staticmethod
     def add_args(parser):
         parser_mqtt = parser.add_argument_group("MQTT")
@@ -48,3 +79,202 @@ class MqttConnection:
         parser_mqtt.add_argument("--tls-ca", help="CA certificate that has signed the server's certificate")
         parser_mqtt.add_argument("--username", "-u", help="Username")
         parser_mqtt.add_argument("--password", "-p", help="Password")
+        return parser_mqtt
+
+
+class MqttConnection(MqttClient):
+    """Publishing side of the connection, with an in-flight window and an optional outbox"""
+    def __init__(self, client_id: str, args, log=logging.getLogger()):
+        super().__init__(client_id, args, log)
+        self.client.on_publish = self.on_publish
+        self.qos = args.qos
+        self.publish_timeout = args.publish_timeout
+        self.client.max_inflight_messages_set(args.max_inflight)
+        # Messages that have been handed to paho but not yet acknowledged (QoS 1 and 2)
+        # or written to the socket (QoS 0), by message id
+        self.window = threading.BoundedSemaphore(args.max_inflight)
+        self.inflight: Dict[int, Tuple[float, int]] = {}
+        # paho calls on_publish with its own locks held, so client.publish() is called without
+        # holding inflight_lock. Acknowledgements that arrive before the message is recorded in
+        # inflight are kept here while publish() calls are under way.
+        self.publishing = 0
+        self.early_acks: Set[int] = set()
+        self.inflight_lock = threading.RLock()
+        self.ack_count = 0
+        self.ack_time_total = 0.0
+        self.ack_time_max = 0.0
+        self.next_stats = time.monotonic() + STATS_INTERVAL
+        self.outbox = None
+        self.replay_thread = None
+        if args.outbox is not None:
+            self.outbox = Outbox(args.outbox, int(args.outbox_size * 1024 * 1024), log=self.log)
+
+    def publish(self, topic: str, data: str, timestamp: float = None, block=True) -> bool:
+        """Publish a message, waiting for room in the in-flight window if block is set.
+        Returns False if the message had to be dropped."""
+        if timestamp is None:
+            timestamp = time.time()
+        # While older messages are waiting in the outbox, new ones are queued behind them
+        if self.outbox is not None and \
+                self.outbox.append(timestamp, topic, data, force=not self.client.is_connected()):
+            if self.client.is_connected():
+                # Resume a replay that was interrupted while the connection stayed up
+                self.start_replay()
+            return True
+        if self.send(topic, data, block) is not None:
+            return True
+        if self.outbox is not None:
+            return self.outbox.append(timestamp, topic, data, force=True)
+        self.log.warning(f'Dropped message on {topic}')
+        return False
+
+    def send(self, topic: str, data: str, block=True) -> Optional[mqtt.MQTTMessageInfo]:
+        if block:
+            acquired = self.window.acquire(timeout=self.publish_timeout)
+        else:
+            acquired = self.window.acquire(blocking=False)
+        if not acquired:
+            self.log.debug(f'Publish window full, {len(self.inflight)} messages in flight')
+            return None
+        with self.inflight_lock:
+            self.publishing += 1
+        start_time = time.monotonic()
+        info = self.client.publish(topic, data, qos=self.qos)
+        with self.inflight_lock:
+            self.publishing -= 1
+            # Without a connection, paho keeps QoS 1 and 2 messages and sends them after reconnecting
+            queued = info.rc == mqtt.MQTT_ERR_NO_CONN and self.qos > 0
+            if info.rc != mqtt.MQTT_ERR_SUCCESS and not queued:
+                self.window.release()
+                result = None
+            elif info.mid in self.early_acks or (not queued and info.is_published()):
+                # on_publish was already called
+                self.early_acks.discard(info.mid)
+                self.window.release()
+                result = info
+            else:
+                self.inflight[info.mid] = (start_time, self.qos)
+                result = info
+            if not self.publishing:
+                # Left over from messages not sent through the window
+                self.early_acks.clear()
+        if result is None:
+            return None
+        if time.monotonic() >= self.next_stats:
+            self.log_stats()
+        return info
+
+    def log_stats(self):
+        with self.inflight_lock:
+            mean = self.ack_time_total / self.ack_count if self.ack_count else 0.0
+            self.log.debug(f'{self.ack_count} messages acknowledged, {len(self.inflight)} in flight, '
+                           f'latency mean {mean * 1000:.1f} ms, max {self.ack_time_max * 1000:.1f} ms')
+            self.ack_count = 0
+            self.ack_time_total = 0.0
+            self.ack_time_max = 0.0
+            self.next_stats = time.monotonic() + STATS_INTERVAL
+
+    def on_publish(self, mqtt_client, userdata, mid):
+        with self.inflight_lock:
+            sent = self.inflight.pop(mid, None)
+            if sent is None:
+                # Not sent through the window, like the state messages, or not recorded yet
+                if self.publishing:
+                    self.early_acks.add(mid)
+                return
+            latency = time.monotonic() - sent[0]
+            self.ack_count += 1
+            self.ack_time_total += latency
+            self.ack_time_max = max(self.ack_time_max, latency)
+        self.window.release()
+
+    def on_disconnect(self, mqtt_client, userdata, rc):
+        super().on_disconnect(mqtt_client, userdata, rc)
+        # paho drops unsent QoS 0 messages on disconnect, others are resent after reconnecting
+        with self.inflight_lock:
+            for mid, (_, qos) in list(self.inflight.items()):
+                if qos == 0:
+                    del self.inflight[mid]
+                    self.window.release()
+
+    def replay(self):
+        count = 0
+        while True:
+            segment = self.outbox.take()
+            if segment is None:
+                break
+            info = None
+            for timestamp, topic, data in Outbox.read(segment):
+                info = self.send(topic, timestamped(data, timestamp))
+                if info is None:
+                    self.log.warning('Replay interrupted')
+                    return
+                count += 1
+            # Only forget the segment when all of it has been sent
+            if info is not None:
+                # A message that paho is holding until it reconnects isn't acknowledged, and
+                # both wait_for_publish() and is_published() raise for it
+                if info.rc == mqtt.MQTT_ERR_SUCCESS:
+                    info.wait_for_publish(REPLAY_TIMEOUT)
+                if info.rc != mqtt.MQTT_ERR_SUCCESS or not info.is_published():
+                    self.log.warning('Replay interrupted: not acknowledged')
+                    return
+            self.outbox.remove(segment)
+        self.log.info(f'Replayed {count} messages from outbox')
+
+    def start_replay(self):
+        if self.replay_thread is None or not self.replay_thread.is_alive():
+            # Replay from a separate thread, since waiting for publishes would block the network loop
+            self.replay_thread = threading.Thread(target=self.replay, name='outbox-replay', daemon=True)
+            self.replay_thread.start()
+
+    def on_connect(self, mqtt_client, userdata, flags, rc):
+        super().on_connect(mqtt_client, userdata, flags, rc)
+        if rc == 0 and self.outbox is not None and self.outbox.active:
+            self.start_replay()
+
+    @staticmethod
+    def add_args(parser):
+        parser_mqtt = MqttClient.add_args(parser)
+        parser_mqtt.add_argument("--qos", type=int, choices=(0, 1, 2), default=0,
+                                 help="Quality of service for published messages")
+        parser_mqtt.add_argument("--max-inflight", metavar="N", type=int, default=100,
+                                 help="Maximum number of published messages waiting to be sent or acknowledged")
+        parser_mqtt.add_argument("--publish-timeout", metavar="SEC", type=float, default=10,
+                                 help="Time to wait for room among the in-flight messages [seconds]")
+        parser_mqtt.add_argument("--outbox", metavar="DIR",
+                                 help="Directory to keep messages in while the broker is unreachable")
+        parser_mqtt.add_argument("--outbox-size", metavar="MB", type=float, default=16,
+                                 help="Maximum size of the outbox [MB]")
+
+
+class MqttSubscriber(MqttClient):
+    """Receiving side of the connection, dispatching messages to handlers by topic filter.
+    Handlers are called with the topic levels matched by wildcards, joined by '/', and the payload."""
+    def __init__(self, client_id: str, args, log=logging.getLogger()):
+        super().__init__(client_id, args, log)
+        self.client.on_message = self.on_message
+        self.topics = TopicTrie()
+        self.subscribe('$SYS/broker/version', self.on_broker_version)
+
+    def subscribe(self, topic_filter: str, handler: Callable[[str, bytes], None]):
+        self.topics.add(topic_filter, handler)
+        if self.client.is_connected():
+            self.client.subscribe(topic_filter)
+
+    def on_connect(self, mqtt_client, userdata, flags, rc):
+        super().on_connect(mqtt_client, userdata, flags, rc)
+        if rc == 0:
+            for topic_filter in self.topics.filters():
+                self.client.subscribe(topic_filter)
+
+    def on_message(self, mqtt_client, userdata, msg):
+        self.log.debug(f'Message: {msg.topic}: {msg.payload}')
+        for handler, wildcard_levels in self.topics.match(msg.topic):
+            try:
+                handler('/'.join(wildcard_levels), msg.payload)
+            except Exception as e:
+                self.log.warning(f'Bad payload: {msg.topic}, {msg.payload}: {e}')
+
+    def on_broker_version(self, _, payload: bytes):
+        self.log.info(f'Broker version: {payload.decode(errors="replace")}')
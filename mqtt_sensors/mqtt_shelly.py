@@ -5,29 +5,64 @@
 import argparse
 import logging
 import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from http.server import HTTPServer, BaseHTTPRequestHandler
 import platform
 from urllib.parse import urlparse, parse_qs
 
+from .deadband import Deadband
 from .mqtt_connection import MqttConnection
 
+# Connections accepted per worker thread, handled as workers become free. More are refused.
+PENDING_PER_WORKER = 16
+
 log = logging.getLogger('shelly_to_mqtt')
-mqtt_connection: MqttConnection = None
+
+
+class ShellyReceiver:
+    """Publishes the reports from the sensors, with the deadband applied"""
+    def __init__(self, mqtt_connection: MqttConnection, deadband: Deadband):
+        self.mqtt_connection = mqtt_connection
+        self.deadband = deadband
+        self.lock = threading.Lock()
+
+    def report(self, sensor_id: str, temp: float, hum: float):
+        log.info(f'Report from {sensor_id}: temp={temp:.2f}°C RH={hum:.1f}%')
+        with self.lock:
+            changed = self.deadband.check(sensor_id, temp, hum)
+        if changed:
+            doc = f'{{"temperature":{temp:.2f}, "humidity":{hum:.1f}}}'
+            # Don't keep the device waiting if the broker is falling behind
+            self.mqtt_connection.publish(f'shelly/{sensor_id}', doc, block=False)
+        else:
+            log.debug(f'Suppressing unchanged report from {sensor_id}')
 
 
 class RequestHandler(BaseHTTPRequestHandler):
+    # Keep-alive, which needs a Content-Length on every response
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        # Idle and stalled connections are closed after this long
+        self.timeout = self.server.request_timeout
+        super().setup()
+
     def do_GET(self):
         ua = self.headers.get('User-Agent')
         log.debug(f'Request from {self.client_address}: {self.path} ({ua})')
         o = urlparse(self.path)
         qs = parse_qs(o.query)
-        hum = float(qs.get('hum', [math.nan])[0])
-        temp = float(qs.get('temp', [math.nan])[0])
+        try:
+            hum = float(qs.get('hum', [math.nan])[0])
+            temp = float(qs.get('temp', [math.nan])[0])
+        except ValueError:
+            self.send_error(400, 'Bad value')
+            return
         sensor_id = qs.get('id', [''])[0]
-        log.info(f'Report from {sensor_id}: temp={temp:.2f}°C RH={hum:.1f}%')
-        doc = f'{{"temperature":{temp:.2f}, "humidity":{hum:.1f}}}'
-        mqtt_connection.publish(f'shelly/{sensor_id}', doc)
+        self.server.receiver.report(sensor_id, temp, hum)
         self.send_response(200)
+        self.send_header('Content-Length', '0')
         self.end_headers()
 
     def log_message(self, format, *args):
@@ -39,10 +74,48 @@ class RequestHandler(BaseHTTPRequestHandler):
                    message))
 
 
-def run_http_server(port):
-    httpd = HTTPServer(('', port), RequestHandler)
+class PooledHTTPServer(HTTPServer):
+    """Handles each connection on a pool of worker threads, so that a slow client only holds up
+    its own worker. Connections that find too many others waiting for a worker are closed."""
+    # Many devices can wake up at once
+    request_queue_size = 128
+
+    def __init__(self, address, handler, receiver: ShellyReceiver, workers: int, request_timeout: float):
+        super().__init__(address, handler)
+        self.receiver = receiver
+        self.request_timeout = request_timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='http')
+        self.slots = threading.BoundedSemaphore(workers * PENDING_PER_WORKER)
+
+    def process_request(self, request, client_address):
+        """Override from socketserver.BaseServer"""
+        if not self.slots.acquire(blocking=False):
+            log.warning(f'Too many connections, refusing {client_address}')
+            self.shutdown_request(request)
+            return
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def run_http_server(port: int, receiver: ShellyReceiver, workers: int, request_timeout: float):
+    httpd = PooledHTTPServer(('', port), RequestHandler, receiver, workers, request_timeout)
     log.info(f'Listening on port {port}')
-    httpd.serve_forever()
+    try:
+        httpd.serve_forever()
+    finally:
+        httpd.server_close()
 
 
 def run():
@@ -50,20 +123,25 @@ def run():
 
     parser = argparse.ArgumentParser(description='Publish Shelly H&T sensors on MQTT')
     parser.add_argument('--port', default=7123, type=int, help='HTTP server port')
+    parser.add_argument('--workers', metavar='N', default=32, type=int,
+                        help='Number of connections handled at once')
+    parser.add_argument('--timeout', metavar='SEC', default=10, type=float,
+                        help='Close connections that are idle or stalled for this long [seconds]')
     parser.add_argument('--debug', default=False, action='store_true',
                         help='Enable debug printouts')
+    Deadband.add_args(parser)
     MqttConnection.add_args(parser)
     args = parser.parse_args()
 
     if args.debug:
         logging.getLogger().setLevel('DEBUG')
 
-    global mqtt_connection
     mqtt_connection = MqttConnection(f'shelly-{platform.node()}', args, log)
+    receiver = ShellyReceiver(mqtt_connection, Deadband.from_args(args))
 
     try:
         mqtt_connection.start()
-        run_http_server(args.port)
+        run_http_server(args.port, receiver, args.workers, args.timeout)
     except KeyboardInterrupt:
         log.info('Exit on CTRL-C')
     finally:
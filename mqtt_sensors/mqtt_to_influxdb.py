@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+#
+# Pull sensor readings from MQTT and write them to Influxdb
+#
+
+import argparse
+import http.client
+import json
+import logging
+import math
+import platform
+import queue
+import threading
+import time
+import urllib.error
+from typing import Callable, List, Optional, Tuple
+
+from .influx import InfluxWriter, sample_line
+from .json_fields import JsonFields
+from .mqtt_connection import MqttClient, MqttSubscriber
+from .outbox import Outbox
+
+# Maximum number of lines waiting to be written before MQTT handling is held up
+QUEUE_SIZE = 100000
+# Time to wait after a failed write, doubled for every failure in a row up to RETRY_MAX [seconds]
+RETRY_MIN = 1.0
+RETRY_MAX = 300.0
+
+log = logging.getLogger('mqtt_to_influxdb')
+
+
+class InfluxSink:
+    """Writes queued lines to Influxdb from a background thread, a batch at a time when it reaches
+    batch_size lines or batch_interval seconds after its first line.
+
+    While Influxdb can't be reached, batches are spilled to an outbox, if there is one, and written
+    when it is back. Otherwise they are dropped. Lines that are written twice after an interrupted
+    replay replace the same points, so replays don't need to be exact."""
+    def __init__(self, influx: InfluxWriter, batch_size: int, batch_interval: float,
+                 spill: Optional[Outbox] = None):
+        self.influx = influx
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.spill = spill
+        self.retry_delay = 0.0
+        # Influxdb isn't tried again until then, after a failed write
+        self.retry_at = 0.0
+        self.queue: queue.Queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self.thread = threading.Thread(target=self.run, name='influx-writer')
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        """Write what is left in the queue and stop"""
+        self.queue.put(None)
+        self.thread.join()
+
+    def put(self, line: str):
+        self.queue.put(line)
+
+    def get_batch(self) -> Tuple[List[str], bool]:
+        """Wait for lines, and collect them until the batch is full or the batch interval
+        has passed. Also returns whether the sink has been stopped."""
+        try:
+            # Wake up to retry spilled batches
+            spilled = self.spill is not None and self.spill.active
+            item = self.queue.get(timeout=self.batch_interval if spilled else None)
+        except queue.Empty:
+            return [], False
+        if item is None:
+            return [], True
+        batch = [item]
+        deadline = time.monotonic() + self.batch_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def try_write(self, lines: List[str]) -> bool:
+        """Returns False if the write should be tried again later"""
+        start_time = time.monotonic()
+        try:
+            self.influx.write(lines)
+        except urllib.error.HTTPError as e:
+            if 400 <= e.code < 500 and e.code != 429:
+                # Rejected, and would be rejected again
+                log.error(f'Influxdb rejected {len(lines)} lines: {e.code} {e.read()[:200]!r}')
+                return True
+            log.warning(f'Failed to write {len(lines)} lines: {e}')
+        except (urllib.error.URLError, http.client.HTTPException, OSError) as e:
+            log.warning(f'Failed to write {len(lines)} lines: {e!r}')
+        else:
+            self.retry_delay = 0.0
+            log.debug(f'Wrote {len(lines)} lines in {(time.monotonic() - start_time) * 1000:.1f} ms, '
+                      f'{self.queue.qsize()} queued')
+            return True
+        self.retry_delay = min(max(self.retry_delay * 2, RETRY_MIN), RETRY_MAX)
+        self.retry_at = time.monotonic() + self.retry_delay
+        log.info(f'Retrying in {self.retry_delay:.1f} s')
+        return False
+
+    def write(self, lines: List[str]):
+        timestamp = time.time()
+        # While older batches are waiting in the spill, new ones are queued behind them
+        if self.spill is not None and self.spill.append(timestamp, 'influx', '\n'.join(lines)):
+            return
+        if time.monotonic() >= self.retry_at and self.try_write(lines):
+            return
+        if self.spill is not None:
+            self.spill.append(timestamp, 'influx', '\n'.join(lines), force=True)
+        else:
+            log.warning(f'Dropped {len(lines)} lines')
+
+    def replay(self):
+        """Write spilled batches, a segment at a time, until the spill is empty or a write fails"""
+        count = 0
+        while time.monotonic() >= self.retry_at:
+            segment = self.spill.take()
+            if segment is None:
+                if count:
+                    log.info(f'Wrote {count} spilled lines')
+                return
+            # Small batches are written together
+            lines: List[str] = []
+            for _, _, data in Outbox.read(segment):
+                lines += data.split('\n')
+                if len(lines) >= self.batch_size:
+                    if not self.try_write(lines):
+                        return
+                    count += len(lines)
+                    lines = []
+            if lines:
+                if not self.try_write(lines):
+                    return
+                count += len(lines)
+            # Only forget the segment when all of it has been written
+            self.spill.remove(segment)
+
+    def run(self):
+        stopped = False
+        while not stopped:
+            batch, stopped = self.get_batch()
+            try:
+                if batch:
+                    self.write(batch)
+                if self.spill is not None and self.spill.active:
+                    self.replay()
+            except Exception as e:
+                # Anything else would stop the thread and leave the queue to fill up
+                log.error(f'Failed to write {len(batch)} lines: {e!r}')
+
+
+sink: Optional[InfluxSink] = None
+json_fields = JsonFields()
+
+
+def update_influx(timestamp: int, source_name: str, value: float):
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug(f'Reading at {timestamp} for {source_name}: {value:.3f}')
+    if not math.isfinite(value):
+        # Not valid in line protocol, and would get the whole batch rejected
+        return
+    sink.put(sample_line(source_name, timestamp, value))
+
+
+def handle_float_topic(node_name, payload):
+    if payload.startswith(b'{'):
+        # Delayed message with the original sample time attached
+        content = json.loads(payload)
+        update_influx(int(content['time']), node_name, float(content['value']))
+        return
+    update_influx(int(time.time()), node_name, float(payload))
+
+
+def handle_batch_topic(node_name, payload):
+    content = json.loads(payload)
+    timestamp = int(content['time'])
+    for source_name, value in content['temperature'].items():
+        update_influx(timestamp, source_name, float(value))
+
+
+def handle_json_topic(node_name, payload):
+    content = json.loads(payload)
+    # Delayed messages carry their original sample time
+    timestamp = content.get('time')
+    timestamp = int(timestamp if timestamp is not None else time.time())
+    # Series named like mqtt_to_sql names them
+    for source_name, value in json_fields.values(node_name, content):
+        update_influx(timestamp, source_name, value)
+
+
+topics: List[Tuple[str, Callable[[str, bytes], None]]] = [
+    ('temperature/+', handle_float_topic),
+    ('temperature-batch/+', handle_batch_topic),
+    ('zigbee2mqtt/+', handle_json_topic),
+    ('shelly/+', handle_json_topic),
+]
+
+
+def run():
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Pull sensor readings from MQTT and write them to Influxdb")
+    parser.add_argument("--debug", default=False, action="store_true", help="Enable debug printouts")
+    parser.add_argument("--batch-size", metavar="N", type=int, default=5000,
+                        help="Maximum number of points written at once")
+    parser.add_argument("--batch-interval", metavar="SEC", type=float, default=1.0,
+                        help="Maximum time a point waits to be written [seconds]")
+    JsonFields.add_args(parser)
+    parser.add_argument("--spill", metavar="DIR",
+                        help="Directory to keep points in while Influxdb is unreachable")
+    parser.add_argument("--spill-size", metavar="MB", type=float, default=64,
+                        help="Maximum size of the spill directory [MB]")
+    parser_influx = parser.add_argument_group("Influxdb")
+    parser_influx.add_argument("--url", metavar="URL", default="http://localhost:8086", help="Influxdb URL")
+    parser_influx.add_argument("--bucket", metavar="BUCKET", help="Bucket name", required=True)
+    parser_influx.add_argument("--org", metavar="ORG", help="Organization name", required=True)
+    parser_influx.add_argument("--token", metavar="TOKEN", help="Influxdb access token", required=True)
+    MqttClient.add_args(parser)
+    args = parser.parse_args()
+
+    if args.debug:
+        logging.getLogger().setLevel('DEBUG')
+
+    client_id = f'mqtt_to_influxdb-{platform.node()}'
+    global sink, json_fields
+    json_fields = JsonFields.from_args(args)
+    spill = None
+    if args.spill is not None:
+        spill = Outbox(args.spill, int(args.spill_size * 1024 * 1024), log=log)
+    influx = InfluxWriter(args.url, args.org, args.bucket, args.token)
+    sink = InfluxSink(influx, args.batch_size, args.batch_interval, spill)
+    sink.start()
+
+    subscriber = MqttSubscriber(client_id, args, log)
+    for topic_filter, handler in topics:
+        subscriber.subscribe(topic_filter, handler)
+    log.info(f'Connected as {client_id}')
+
+    try:
+        subscriber.loop_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        subscriber.stop()
+        sink.stop()
+
+
+if __name__ == '__main__':
+    run()
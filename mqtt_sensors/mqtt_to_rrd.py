@@ -6,25 +6,48 @@
 import argparse
 import logging
 import platform
-from collections import namedtuple
 
-import paho.mqtt.client as mqtt
-import time
+import json
 import re
-import subprocess
+import time
+import queue
+import shlex
 import sys
+import threading
+from collections import OrderedDict
 from pathlib import Path
-from contextlib import suppress
-from typing import Dict, List
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .mqtt_connection import MqttClient, MqttSubscriber
+from .rrd_backend import RrdCached, RrdError, RrdPipe
+
+# Maximum number of updates waiting to be written before MQTT handling is held up
+QUEUE_SIZE = 100000
+# Data source definitions, after the DS name. 'value' is used for single sensor readings.
+DATA_SOURCES: Dict[str, str] = {
+    'value': 'GAUGE:4000:-100:10000',
+    't': 'GAUGE:4000:-100:10000',
+    'rh': 'GAUGE:4000:0:100',
+    'p': 'GAUGE:4000:0:2000',
+    'link': 'GAUGE:4000:0:255',
+    'v': 'GAUGE:4000:0:U',
+}
+# Fields stored from JSON messages, and their data source in the device's RRD
+JSON_FIELDS: Dict[str, str] = {
+    'temperature': 't',
+    'humidity': 'rh',
+    'pressure': 'p',
+    'linkquality': 'link',
+    'voltage': 'v',
+}
 
-topic_data = namedtuple('topic_data', 'mqtt,re,handler')
 rrd_path = None
-last_samples: Dict[str, int] = {}
 
 log = logging.getLogger("mqtt_to_rrd")
 
 
-def create_rrd(rrdfile, prefill_src=None, prefill_ds=None):
+def create_rrd(backend: RrdPipe, rrdfile, prefill_src=None, prefill_ds=None, data_sources=("value", ),
+               start: Optional[int] = None):
     try:
         log.info("Creating RRD %s" % rrdfile)
         prefill_opts = []
@@ -32,72 +55,233 @@ def create_rrd(rrdfile, prefill_src=None, prefill_ds=None):
         if prefill_src is not None:
             prefill_opts = ["--source", prefill_src]
             prefill_ds_exp = "=" + prefill_ds
+        if start is not None:
+            prefill_opts += ["--start", "%d" % start]
         # 1 year with minute level data
         HIGH_RES_SAMPLES = 365*24*60
         # ten years with hour level data
         LOW_RES_SAMPLES = 10*365*24
-        completed = subprocess.run(["rrdtool", "create", str(rrdfile),
-                *prefill_opts,
-                "-O", "--step", "60",
-                "DS:value%s:GAUGE:4000:-100:10000" % prefill_ds_exp,
-                "RRA:AVERAGE:0.5:1:%d" % HIGH_RES_SAMPLES,
-                "RRA:AVERAGE:0.5:60:%d" % LOW_RES_SAMPLES,
-                "RRA:MAX:0.5:1:%d" % HIGH_RES_SAMPLES,
-                "RRA:MAX:0.5:60:%d" % LOW_RES_SAMPLES,
-                "RRA:MIN:0.5:1:%d" % HIGH_RES_SAMPLES,
-                "RRA:MIN:0.5:60:%d" % LOW_RES_SAMPLES])
-        if completed.returncode != 0:
-            log.error("RRD create failed")
-    except FileNotFoundError as e:
-        log.error(e)
+        backend.run("create", str(rrdfile),
+                    *prefill_opts,
+                    "-O", "--step", "60",
+                    *["DS:%s%s:%s" % (ds, prefill_ds_exp if ds == "value" else "", DATA_SOURCES[ds])
+                      for ds in data_sources],
+                    "RRA:AVERAGE:0.5:1:%d" % HIGH_RES_SAMPLES,
+                    "RRA:AVERAGE:0.5:60:%d" % LOW_RES_SAMPLES,
+                    "RRA:MAX:0.5:1:%d" % HIGH_RES_SAMPLES,
+                    "RRA:MAX:0.5:60:%d" % LOW_RES_SAMPLES,
+                    "RRA:MIN:0.5:1:%d" % HIGH_RES_SAMPLES,
+                    "RRA:MIN:0.5:60:%d" % LOW_RES_SAMPLES)
+    except RrdError as e:
+        log.error("RRD create failed: %s" % e)
+        return False
+    return True
 
 
-def update_rrd(timestamp, source_name, value):
-    log.debug("Reading at %d for %s: %.3f" % (timestamp, source_name, value))
-    with suppress(KeyError):
-        if last_samples[source_name] == timestamp:
-            log.debug("Suppressing duplicate reading")
-            return
-    last_samples[source_name] = timestamp
-
-    rrdfile = Path(rrd_path, "%s.rrd" % source_name)
-    if not rrdfile.is_file():
-        create_rrd(str(rrdfile))
-    try:
-        completed = subprocess.run(["rrdtool", "update", str(rrdfile),
-                "%d:%f" % (timestamp, value)])
-        if completed.returncode != 0:
-            log.error("RRD update failed")
-    except FileNotFoundError as e:
-        log.error(e)
+class RrdFile:
+    __slots__ = ('data_sources', 'last_update')
 
+    def __init__(self, data_sources: List[str], last_update: int):
+        self.data_sources = data_sources
+        self.last_update = last_update
 
-def on_connect(client, userdata, flags, rc):
-    log.info("Connected: %s" % rc)
 
-    client.subscribe("$SYS/broker/version")
-    for topic in topics:
-        client.subscribe(topic.mqtt)
+def read_info(backend: RrdPipe, rrdfile) -> RrdFile:
+    """Get the DS names, in order, and the last update time of an RRD"""
+    indexes = {}
+    last_update = 0
+    for line in backend.info(str(rrdfile)):
+        match = re.match(r"ds\[(\w+)\]\.index = (\d+)$", line)
+        if match:
+            indexes[match.group(1)] = int(match.group(2))
+        elif line.startswith("last_update = "):
+            last_update = int(line[len("last_update = "):])
+    return RrdFile(sorted(indexes, key=indexes.get), last_update)
 
 
-def on_message(client, userdata, msg):
-    log.debug("Message: %s %s" % (msg.topic, msg.payload))
-    for topic in topics:
-        match = topic.re.match(msg.topic)
-        if match:
+class RrdRegistry:
+    """The most recently used RRD files, with their data sources and last update time.
+    A file is read with rrdtool info, or created, when it isn't in the registry."""
+    def __init__(self, backend: RrdPipe, max_files: int):
+        self.backend = backend
+        self.max_files = max_files
+        self.files: OrderedDict[str, RrdFile] = OrderedDict()
+
+    def get(self, rrdfile: str, timestamp: int, values: Dict[str, float]) -> Optional[RrdFile]:
+        rrd = self.files.get(rrdfile)
+        if rrd is not None:
+            self.files.move_to_end(rrdfile)
+            return rrd
+        if Path(rrdfile).is_file():
+            try:
+                rrd = read_info(self.backend, rrdfile)
+            except (RrdError, ValueError) as e:
+                log.error("Reading RRD info for %s failed: %s" % (rrdfile, e))
+                return None
+        else:
+            data_sources = [ds for ds in DATA_SOURCES if ds in values]
+            # Starting just before the first update, which can be older than now
+            if not create_rrd(self.backend, rrdfile, data_sources=data_sources, start=timestamp - 1):
+                return None
+            rrd = RrdFile(data_sources, timestamp - 1)
+        self.files[rrdfile] = rrd
+        if len(self.files) > self.max_files:
+            self.files.popitem(last=False)
+        return rrd
+
+    def forget(self, rrdfile: str):
+        self.files.pop(rrdfile, None)
+
+
+class RrdWriter:
+    """Writes queued updates from a background thread. Updates collected during
+    batch_interval seconds are sent with one update command per RRD file.
+
+    An RRD can hold several data sources, all updated at once. Missing data sources are
+    added to the file, and data sources missing from an update are written as unknown."""
+    def __init__(self, backend: RrdPipe, batch_size: int, batch_interval: float, max_files: int):
+        self.backend = backend
+        self.registry = RrdRegistry(backend, max_files)
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.queue: queue.Queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self.thread = threading.Thread(target=self.run, name='rrd-writer')
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        """Write what is left in the queue and stop"""
+        self.queue.put(None)
+        self.thread.join()
+        self.backend.stop()
+
+    def put(self, timestamp: int, source_name: str, values: Dict[str, float]):
+        self.queue.put((timestamp, source_name, values))
+
+    def add_data_sources(self, rrdfile: str, rrd: RrdFile, values: Dict[str, float],
+                         pending: Dict[str, List[str]]):
+        for ds in values:
+            if ds not in rrd.data_sources:
+                log.info("Adding DS %s to %s" % (ds, rrdfile))
+                if rrdfile in pending:
+                    # Written before the file changes shape
+                    self.backend.update({rrdfile: pending.pop(rrdfile)})
+                # Only tried once, the value is dropped if it fails
+                rrd.data_sources.append(ds)
+                try:
+                    self.backend.flush(rrdfile)
+                    self.backend.run("tune", rrdfile, "DS:%s:%s" % (ds, DATA_SOURCES[ds]))
+                except RrdError as e:
+                    log.error("RRD tune failed: %s" % e)
+
+    def get_batch(self) -> Tuple[List[Tuple[int, str, Dict[str, float]]], bool]:
+        """Wait for updates, and collect them until the batch is full or the batch interval
+        has passed. Also returns whether the writer has been stopped."""
+        item = self.queue.get()
+        if item is None:
+            return [], True
+        batch = [item]
+        deadline = time.monotonic() + self.batch_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def write(self, batch: List[Tuple[int, str, Dict[str, float]]]):
+        start_time = time.monotonic()
+        updates: Dict[str, List[str]] = {}
+        for timestamp, source_name, values in batch:
+            rrdfile = str(Path(rrd_path, "%s.rrd" % source_name))
+            rrd = self.registry.get(rrdfile, timestamp, values)
+            if rrd is None:
+                continue
+            if timestamp <= rrd.last_update:
+                # Would be rejected by rrdtool
+                log.debug("Dropping reading at %d for %s, last update was at %d" %
+                          (timestamp, source_name, rrd.last_update))
+                continue
+            rrd.last_update = timestamp
+            self.add_data_sources(rrdfile, rrd, values, updates)
+            updates.setdefault(rrdfile, []).append(":".join(
+                ["%d" % timestamp] + ["%f" % values[ds] if ds in values else "U" for ds in rrd.data_sources]))
+        for rrdfile in self.backend.update(updates):
+            # Read the file again next time, in case it has been changed behind our back
+            self.registry.forget(rrdfile)
+        log.debug("Wrote %d updates to %d files in %.1f ms, %d queued" %
+                  (len(batch), len(updates), (time.monotonic() - start_time) * 1000, self.queue.qsize()))
+
+    def run(self):
+        stopped = False
+        while not stopped:
+            batch, stopped = self.get_batch()
+            if not batch:
+                continue
             try:
-                topic.handler(match.group(1), msg.payload)
+                self.write(batch)
             except Exception as e:
-                log.warning(f'Bad payload: {msg.topic}, {msg.payload}: {e}')
+                # Anything else would stop the thread and leave the queue to fill up
+                log.error("Failed to write %d updates: %r" % (len(batch), e))
+                # The registry may be ahead of what was written to these files
+                for _, source_name, _ in batch:
+                    self.registry.forget(str(Path(rrd_path, "%s.rrd" % source_name)))
+
+
+writer: Optional[RrdWriter] = None
+
+
+def update_rrd(timestamp, source_name, value):
+    log.debug("Reading at %d for %s: %.3f" % (timestamp, source_name, value))
+    update_rrd_sources(timestamp, source_name, {"value": value})
+
+
+def update_rrd_sources(timestamp, source_name, values: Dict[str, float]):
+    """Update several data sources of one RRD at once"""
+    writer.put(timestamp, source_name, values)
 
 
 def handle_float_topic(node_name, payload):
+    if payload.startswith(b'{'):
+        # Delayed message with the original sample time attached
+        content = json.loads(payload)
+        update_rrd(int(content['time']), node_name, float(content['value']))
+        return
     value = float(payload)
     update_rrd(int(time.time()), node_name, value)
 
 
-topics: List[topic_data] = [
-    topic_data('temperature/+', re.compile(r'temperature/(.*)'), handle_float_topic),
+def handle_batch_topic(node_name, payload):
+    content = json.loads(payload)
+    timestamp = int(content['time'])
+    for source_name, value in content['temperature'].items():
+        update_rrd(timestamp, source_name, float(value))
+
+
+def handle_json_topic(node_name, payload):
+    content = json.loads(payload)
+    # Delayed messages carry their original sample time
+    timestamp = content.get('time')
+    timestamp = int(timestamp if timestamp is not None else time.time())
+    values = {ds: float(content[field]) for field, ds in JSON_FIELDS.items()
+              if content.get(field) is not None}
+    log.debug("Reading at %d for %s: %s" % (timestamp, node_name, values))
+    if values:
+        update_rrd_sources(timestamp, node_name, values)
+
+
+topics: List[Tuple[str, Callable[[str, bytes], None]]] = [
+    ('temperature/+', handle_float_topic),
+    ('temperature-batch/+', handle_batch_topic),
+    ('zigbee2mqtt/+', handle_json_topic),
+    ('shelly/+', handle_json_topic),
 ]
 
 
@@ -105,52 +289,57 @@ def run():
     logging.basicConfig(level=logging.INFO)
 
     parser = argparse.ArgumentParser(description="Pull temperature readings from MQTT and add to an RRD")
-    parser.add_argument("--mqtt", metavar="ADDRESS", default="localhost",
-                        help="MQTT broker address")
     parser.add_argument("--rrd-path", metavar="PATH", default=".",
                         help="Path to directory with RRD files")
     parser.add_argument("--debug", default=False, action="store_true",
                         help="Enable debug printouts")
     parser.add_argument("--prefill", nargs=3, metavar=("NEW-RRD", "OLD-RRD", "DS"),
                         help="Create a prefilled RRD")
-    parser_sec = parser.add_argument_group("Security")
-    parser_sec.add_argument("--tls-insecure", action="store_true", default=False,
-                        help="Disable hostname verification against cert")
-    parser_sec.add_argument("--tls-ca", help="CA certificate that has signed the server's certificate")
-    parser_sec.add_argument("--username", "-u", help="Username")
-    parser_sec.add_argument("--password", "-p", help="Password")
+    parser.add_argument("--rrdtool", metavar="CMD", default="rrdtool",
+                        help="rrdtool command, kept running in pipe mode as 'CMD -'")
+    parser.add_argument("--rrdcached", metavar="SOCKET",
+                        help="Send updates through the rrdcached daemon listening on this UNIX socket")
+    parser.add_argument("--batch-size", metavar="N", type=int, default=1000,
+                        help="Maximum number of updates written at once")
+    parser.add_argument("--batch-interval", metavar="SEC", type=float, default=1.0,
+                        help="Maximum time an update waits to be written [seconds]")
+    parser.add_argument("--max-files", metavar="N", type=int, default=1000,
+                        help="Number of RRD files to keep track of in memory")
+    MqttClient.add_args(parser)
     args = parser.parse_args()
     
     if args.debug:
         logging.getLogger().setLevel('DEBUG')
 
+    command = shlex.split(args.rrdtool)
+    if args.rrdcached is not None:
+        backend = RrdCached(args.rrdcached, command, log)
+    else:
+        backend = RrdPipe(command, log)
+
     if args.prefill:
-        create_rrd(*args.prefill)
+        create_rrd(backend, *args.prefill)
+        backend.stop()
         sys.exit(0)
 
     client_id = "%s-%s" % ("mqtt_to_rrd", platform.node())
-    global rrd_path
+    global rrd_path, writer
     rrd_path = args.rrd_path
+    writer = RrdWriter(backend, args.batch_size, args.batch_interval, args.max_files)
+    writer.start()
 
-    client = mqtt.Client(client_id=client_id, clean_session=True)
-    port = 1883
-    if args.tls_ca is not None:
-        client.tls_set(ca_certs=args.tls_ca)
-        client.tls_insecure_set(args.tls_insecure)
-        port = 8883
-    client.on_connect = on_connect
-    client.on_message = on_message
-    if args.username:
-        client.username_pw_set(args.username, args.password)
-    client.connect(args.mqtt, port=port)
+    subscriber = MqttSubscriber(client_id, args, log)
+    for topic_filter, handler in topics:
+        subscriber.subscribe(topic_filter, handler)
     log.info("Connected as %s" % client_id)
     
     try:
-        client.loop_forever()
+        subscriber.loop_forever()
     except KeyboardInterrupt:
         pass
     finally:
-        client.disconnect()
+        subscriber.stop()
+        writer.stop()
 
 
 if __name__ == "__main__":
@@ -6,99 +6,202 @@
 import argparse
 import logging
 import platform
-from collections import namedtuple
 from contextlib import suppress
-from typing import Dict, List
+from typing import Callable, Dict, List, Optional, Tuple
 
-import paho.mqtt.client as mqtt
 import time
-import re
 import json
+import queue
 import sqlite3
+import threading
 
-topic_data = namedtuple('topic_data', 'mqtt,re,handler')
+from . import sample_db
+
+from .json_fields import JsonFields
+from .mqtt_connection import MqttClient, MqttSubscriber
+
+try:
+    # Much faster than the json module, if installed
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+# Maximum number of samples waiting to be written before MQTT handling is held up
+QUEUE_SIZE = 100000
+# Interval between checks for partitions to make read-only or delete, and samples to compact
+EXPIRY_INTERVAL = 60 * 60
 
-db: sqlite3.Connection = None
-series_ids: Dict[str, int] = {}
 last_samples: Dict[str, int] = {}
 
 log = logging.getLogger('mqtt_to_sql')
 
 
-def get_series_id(name):
-    with suppress(KeyError):
-        return series_ids[name]
-    cur = db.execute('SELECT id FROM series WHERE name=?', (name, ))
-    result = cur.fetchone()
-    if result is not None:
-        id = result[0]
-        series_ids[name] = id
-        return id
-    cur = db.execute('INSERT INTO series (name) VALUES (?)', (name, ))
-    return cur.lastrowid
+class SampleWriter:
+    """Writes queued samples to the database from a background thread, committing a batch
+    when it reaches batch_size samples or commit_interval seconds after its first sample"""
+    def __init__(self, db_file: str, batch_size: int, commit_interval: float,
+                 partitions: Optional[Tuple[str, float, Optional[float]]] = None,
+                 compact_after: Optional[float] = None):
+        # The connection is only used from the writer thread once it has started
+        self.db = sqlite3.connect(db_file, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        # Safe with WAL, but doesn't sync on every commit
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        sample_db.create_schema(self.db)
+        self.maintenance_pending = True
+        self.partitions = None
+        if partitions is not None:
+            self.partitions = sample_db.PartitionWriter(self.db, *partitions)
+        self.compact_after = compact_after
+        self.next_expiry = 0.0
+        self.batch_size = batch_size
+        self.commit_interval = commit_interval
+        self.series_ids: Dict[str, int] = {}
+        self.queue: queue.Queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self.thread = threading.Thread(target=self.run, name='sql-writer')
 
+    def start(self):
+        self.thread.start()
 
-def update_db(timestamp: int, source_name: str, value: float) -> bool:
-    log.debug(f'Reading at {timestamp} for {source_name}: {value:.3f}')
-    with suppress(KeyError):
-        if last_samples[source_name] == timestamp:
-            log.debug("Suppressing duplicate reading")
-            return False
-    last_samples[source_name] = timestamp
-    series_id = get_series_id(source_name)
-    db.execute('INSERT INTO samples (time, series, value) VALUES (?, ?, ?)',
-               (timestamp, series_id, value))
-    return True
+    def stop(self):
+        """Write what is left in the queue and stop"""
+        self.queue.put(None)
+        self.thread.join()
+        self.db.close()
 
+    def put(self, timestamp: int, source_name: str, value: float):
+        self.queue.put((timestamp, source_name, value))
 
-def on_connect(client, userdata, flags, rc):
-    log.info(f'Connected: {rc}')
-    client.subscribe("$SYS/broker/version")
-    for topic in topics:
-        client.subscribe(topic.mqtt)
+    def get_series_id(self, name):
+        with suppress(KeyError):
+            return self.series_ids[name]
+        cur = self.db.execute('SELECT id FROM series WHERE name=?', (name, ))
+        result = cur.fetchone()
+        if result is not None:
+            id = result[0]
+            self.series_ids[name] = id
+            return id
+        cur = self.db.execute('INSERT INTO series (name) VALUES (?)', (name, ))
+        # Forgotten again by rollback() if the insert isn't committed
+        self.series_ids[name] = cur.lastrowid
+        return cur.lastrowid
 
+    def rollback(self):
+        self.db.rollback()
+        self.series_ids.clear()
 
-def on_message(client, userdata, msg):
-    log.debug(f'Message: {msg.topic}: {msg.payload}')
-    for topic in topics:
-        match = topic.re.match(msg.topic)
-        if match:
+    def get_batch(self) -> Tuple[List[Tuple[int, str, float]], bool]:
+        """Wait for samples, and collect them until the batch is full or the commit interval
+        has passed. Also returns whether the writer has been stopped."""
+        try:
+            item = self.queue.get(timeout=EXPIRY_INTERVAL)
+        except queue.Empty:
+            return [], False
+        if item is None:
+            return [], True
+        batch = [item]
+        deadline = time.monotonic() + self.commit_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
             try:
-                topic.handler(match.group(1), msg.payload)
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def write(self, batch: List[Tuple[int, str, float]]):
+        start_time = time.monotonic()
+        if self.partitions is not None:
+            self.partitions.attach(timestamp for timestamp, _, _ in batch)
+        samples = [(timestamp, self.get_series_id(source_name), value)
+                   for timestamp, source_name, value in batch]
+        if self.partitions is not None:
+            added = self.partitions.insert(samples)
+        else:
+            added = sample_db.insert_samples(self.db, samples)
+        # Dropped samples, and those that replaced the value of an existing one, aren't counted again
+        sample_db.update_rollups(self.db, added)
+        self.db.commit()
+        log.debug(f'Wrote {len(batch)} samples in {(time.monotonic() - start_time) * 1000:.1f} ms, '
+                  f'{self.queue.qsize()} queued')
+
+    def run(self):
+        stopped = False
+        while not stopped:
+            if time.monotonic() >= self.next_expiry:
+                self.next_expiry = time.monotonic() + EXPIRY_INTERVAL
+                self.maintenance_pending = True
+                if self.partitions is not None:
+                    try:
+                        self.partitions.expire()
+                    except (sqlite3.Error, OSError) as e:
+                        log.error(f'Partition expiry failed: {e}')
+            if self.maintenance_pending and self.queue.empty():
+                # Background work like migrations and compaction is done between batches
+                compact_before = None
+                if self.compact_after is not None:
+                    compact_before = int(time.time() - self.compact_after)
+                try:
+                    self.maintenance_pending = sample_db.maintenance_step(self.db, compact_before)
+                except Exception as e:
+                    log.error(f'Database maintenance failed: {e!r}')
+                    self.rollback()
+                    self.maintenance_pending = False
+                continue
+            batch, stopped = self.get_batch()
+            if not batch:
+                continue
+            try:
+                self.write(batch)
             except Exception as e:
-                log.warning(f'Bad payload: {msg.topic}, {msg.payload}: {e}')
+                # Anything else, like a bad value, would stop the thread and leave the queue to fill up
+                log.error(f'Failed to write {len(batch)} samples: {e!r}')
+                self.rollback()
+
+
+writer: Optional[SampleWriter] = None
+
+
+def update_db(timestamp: int, source_name: str, value: float) -> bool:
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug(f'Reading at {timestamp} for {source_name}: {value:.3f}')
+    if last_samples.get(source_name) == timestamp:
+        log.debug("Suppressing duplicate reading")
+        return False
+    last_samples[source_name] = timestamp
+    writer.put(timestamp, source_name, value)
+    return True
+
+
+json_fields = JsonFields()
 
 
 def handle_json_topic(node_name, payload):
-    updated = False
-    content = json.loads(payload)
-    if 'temperature' in content:
-        value = content['temperature']
-        source_name = f'{node_name}-t'
-        updated |= update_db(int(time.time()), source_name, value)
-    if 'humidity' in content:
-        value = content['humidity']
-        source_name = f'{node_name}-rh'
-        updated |= update_db(int(time.time()), source_name, value)
-    if 'pressure' in content:
-        value = content['pressure']
-        source_name = f'{node_name}-p'
-        updated |= update_db(int(time.time()), source_name, value)
-    if 'linkquality' in content:
-        value = content['linkquality']
-        source_name = f'{node_name}-link'
-        updated |= update_db(int(time.time()), source_name, value)
-    if 'voltage' in content:
-        value = content['voltage']
-        source_name = f'{node_name}-v'
-        updated |= update_db(int(time.time()), source_name, value)
-    if updated:
-        db.commit()
-
-
-topics: List[topic_data] = [
-    topic_data('zigbee2mqtt/+', re.compile(r'zigbee2mqtt/(.*)'), handle_json_topic),
-    topic_data('shelly/+', re.compile(r'shelly/(.*)'), handle_json_topic),
+    content = json_loads(payload)
+    # Delayed messages carry their original sample time
+    timestamp = content.get('time')
+    timestamp = int(timestamp if timestamp is not None else time.time())
+    for source_name, value in json_fields.values(node_name, content):
+        update_db(timestamp, source_name, value)
+
+
+def handle_batch_topic(node_name, payload):
+    content = json_loads(payload)
+    timestamp = int(content['time'])
+    for source_name, value in content['temperature'].items():
+        update_db(timestamp, source_name, float(value))
+
+
+topics: List[Tuple[str, Callable[[str, bytes], None]]] = [
+    ('zigbee2mqtt/+', handle_json_topic),
+    ('shelly/+', handle_json_topic),
+    ('temperature-batch/+', handle_batch_topic),
 ]
 
 
@@ -106,48 +209,52 @@ def run():
     logging.basicConfig(level=logging.INFO)
 
     parser = argparse.ArgumentParser(description="Pull temperature readings from MQTT and add to a SQL database")
-    parser.add_argument("--mqtt", metavar="ADDRESS", default="localhost", help="MQTT broker address")
     parser.add_argument("--db", metavar="FILE", default="samples.sqlite", help="SQLite database file")
     parser.add_argument("--debug", default=False, action="store_true", help="Enable debug printouts")
-    parser_sec = parser.add_argument_group("Security")
-    parser_sec.add_argument("--tls-insecure", action="store_true", default=False,
-                        help="Disable hostname verification against cert")
-    parser_sec.add_argument("--tls-ca", help="CA certificate that has signed the server's certificate")
-    parser_sec.add_argument("--username", "-u", help="Username")
-    parser_sec.add_argument("--password", "-p", help="Password")
+    parser.add_argument("--commit-size", metavar="N", type=int, default=1000,
+                        help="Maximum number of samples per commit")
+    parser.add_argument("--commit-interval", metavar="SEC", type=float, default=1.0,
+                        help="Maximum time a sample waits to be committed [seconds]")
+    JsonFields.add_args(parser)
+    parser_part = parser.add_argument_group("Storage")
+    parser_part.add_argument("--partition", metavar="SPAN", choices=sample_db.PARTITION_SPANS,
+                             help="Store raw samples in one database file per %s, next to the main database"
+                             % "/".join(sample_db.PARTITION_SPANS))
+    parser_part.add_argument("--cold-after", metavar="DAYS", type=float, default=7,
+                             help="Make partitions read-only this long after they end")
+    parser_part.add_argument("--compact-after", metavar="DAYS", type=float,
+                             help="Move samples older than this into compressed blocks")
+    parser_part.add_argument("--retention", metavar="DAYS", type=float,
+                             help="Delete partitions this long after they end")
+    MqttClient.add_args(parser)
     args = parser.parse_args()
     
     if args.debug:
         logging.getLogger().setLevel('DEBUG')
 
     client_id = f'mqtt_to_sql-{platform.node()}'
-    global db
-    db = sqlite3.connect(args.db)
-    db.execute('CREATE TABLE IF NOT EXISTS series (id INTEGER PRIMARY KEY, name TEXT UNIQUE);')
-    db.execute('CREATE TABLE IF NOT EXISTS samples '
-               '(time INTEGER, series INTEGER, value REAL, '
-               'FOREIGN KEY(series) REFERENCES series(id));')
-    db.commit()
-
-    client = mqtt.Client(client_id=client_id, clean_session=True)
-    port = 1883
-    if args.tls_ca is not None:
-        client.tls_set(ca_certs=args.tls_ca)
-        client.tls_insecure_set(args.tls_insecure)
-        port = 8883
-    client.on_connect = on_connect
-    client.on_message = on_message
-    if args.username:
-        client.username_pw_set(args.username, args.password)
-    client.connect(args.mqtt, port=port)
+    global writer, json_fields
+    json_fields = JsonFields.from_args(args)
+    partitions = None
+    if args.partition is not None:
+        retention = args.retention * 24 * 60 * 60 if args.retention is not None else None
+        partitions = (args.partition, args.cold_after * 24 * 60 * 60, retention)
+    compact_after = args.compact_after * 24 * 60 * 60 if args.compact_after is not None else None
+    writer = SampleWriter(args.db, args.commit_size, args.commit_interval, partitions, compact_after)
+    writer.start()
+
+    subscriber = MqttSubscriber(client_id, args, log)
+    for topic_filter, handler in topics:
+        subscriber.subscribe(topic_filter, handler)
     log.info(f'Connected as {client_id}')
     
     try:
-        client.loop_forever()
+        subscriber.loop_forever()
     except KeyboardInterrupt:
         pass
     finally:
-        client.disconnect()
+        subscriber.stop()
+        writer.stop()
 
 
 if __name__ == '__main__':
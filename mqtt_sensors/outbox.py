@@ -0,0 +1,94 @@
+import json
+import logging
+import threading
+from collections import deque
+from contextlib import suppress
+from pathlib import Path
+from typing import Deque, Iterator, Optional, Tuple
+
+SEGMENT_BYTES = 256 * 1024
+
+
+class Outbox:
+    """Bounded on-disk message queue, kept as a series of append-only segment files.
+
+    Segments are named by a sequence number and read back oldest first. When the total size
+    exceeds max_bytes, the oldest segment is dropped."""
+    def __init__(self, path: str, max_bytes: int, segment_bytes=SEGMENT_BYTES, log=logging.getLogger()):
+        self.log = log.getChild('outbox')
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.lock = threading.Lock()
+        self.segments: Deque[Path] = deque(sorted(self.path.glob('*.seg')))
+        self.size = sum(segment.stat().st_size for segment in self.segments)
+        self.next_seq = int(self.segments[-1].stem) + 1 if self.segments else 0
+        self.writer = None
+        # Set while there are messages that have not been handed back by take()
+        self.active = bool(self.segments)
+        if self.active:
+            self.log.info(f'{self.size} bytes in {len(self.segments)} segments left from last run')
+
+    def append(self, timestamp: float, topic: str, payload: str, force=False) -> bool:
+        """Store a message if forced or if older messages are waiting, to keep them in order.
+        Returns False if the message was not stored."""
+        line = json.dumps({'time': timestamp, 'topic': topic, 'payload': payload},
+                          separators=(',', ':')).encode() + b'\n'
+        with self.lock:
+            if not (force or self.active):
+                return False
+            if self.writer is None or self.writer.tell() >= self.segment_bytes:
+                self._rotate()
+            self.writer.write(line)
+            self.writer.flush()
+            self.size += len(line)
+            self.active = True
+            while self.size > self.max_bytes and len(self.segments) > 1:
+                self._drop(self.segments.popleft())
+        return True
+
+    def take(self) -> Optional[Path]:
+        """Return the oldest segment, without removing it. Returns None, and stops
+        diverting messages to the outbox, when it is empty."""
+        with self.lock:
+            if not self.segments:
+                self.active = False
+                return None
+            if self.writer is not None and Path(self.writer.name) == self.segments[0]:
+                self.writer.close()
+                self.writer = None
+            return self.segments[0]
+
+    def remove(self, segment: Path):
+        with self.lock:
+            if self.segments and self.segments[0] == segment:
+                self.segments.popleft()
+                self._drop(segment, dropped=False)
+
+    @staticmethod
+    def read(segment: Path) -> Iterator[Tuple[float, str, str]]:
+        with suppress(FileNotFoundError):
+            with segment.open('rb') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Partial line from an interrupted write
+                        continue
+                    yield record['time'], record['topic'], record['payload']
+
+    def _rotate(self):
+        if self.writer is not None:
+            self.writer.close()
+        segment = self.path / f'{self.next_seq:010d}.seg'
+        self.next_seq += 1
+        self.writer = segment.open('ab')
+        self.segments.append(segment)
+
+    def _drop(self, segment: Path, dropped=True):
+        with suppress(FileNotFoundError):
+            self.size -= segment.stat().st_size
+            segment.unlink()
+        if dropped:
+            self.log.warning(f'Outbox full, dropped {segment.name}')
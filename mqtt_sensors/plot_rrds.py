@@ -5,8 +5,17 @@
 
 import argparse
 import itertools
+import json
 import logging
+import os
+import re
 import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from .rrd_backend import RrdError, RrdPipe
 
 COLORS = [ 0x4488ee, 0xee4488, 0x88ee44, 0xbb6622,
     0x6622bb, 0x22bb66, 0x2222ee, 0x22ee22, 0xee2222 ]
@@ -14,6 +23,9 @@ BG_COLOR = 0x332222
 FG_COLOR = 0xffffff
 
 SIZE = (768, 256)
+TIMESPANS = ["1d", "1w", "1m", "1y"]
+# Last update time of the RRDs behind each plot, kept in the output directory
+STATE_FILE = "plot_state.json"
 COMMON_OPTS = "-E --lazy --full-size-mode --grid-dash 1:0"
 COLOR_OPTS = "--color SHADEA#{BG:06x} --color SHADEB#{BG:06x} \
 --color BACK#{BG:06x} --color CANVAS#{BG:06x} \
@@ -24,45 +36,119 @@ COLOR_OPTS = "--color SHADEA#{BG:06x} --color SHADEB#{BG:06x} \
 log = logging.getLogger("mqtt_1w")
 
 
-def plot(rrds_and_labels, outdir, timespan="1d"):
-    log.debug("Plotting %s" % timespan)
+def split_ds(rrd: str) -> Tuple[str, str]:
+    """Split "file.rrd:ds" into the file and DS name. The DS defaults to "value"."""
+    path, sep, ds = rrd.rpartition(":")
+    if path and re.fullmatch(r"\w+", ds):
+        return path, ds
+    return rrd, "value"
+
+
+def plot_filename(outdir, timespan, name=None):
+    if name is None:
+        return "%s/plot-%s.png" % (outdir, timespan)
+    return "%s/plot-%s-%s.png" % (outdir, name, timespan)
+
+
+def graph_args(rrds_and_labels, timespan="1d", size=SIZE) -> List[str]:
+    """Arguments to rrdtool graph, after the file name"""
     start = "now-%s" % timespan
-    filename = "%s/plot-%s.png" % (outdir, timespan)
     defs = []
     for i, (rrd, label) in enumerate(rrds_and_labels):
         label = label.replace(":", r"\:")
+        rrd, ds = split_ds(rrd)
         d = [
-                "DEF:sensor{i}={rrd}:value:AVERAGE",
-                 "DEF:sensor{i}_min={rrd}:value:MIN",
-                 "DEF:sensor{i}_max={rrd}:value:MAX",
+                "DEF:sensor{i}={rrd}:{ds}:AVERAGE",
+                 "DEF:sensor{i}_min={rrd}:{ds}:MIN",
+                 "DEF:sensor{i}_max={rrd}:{ds}:MAX",
                  "CDEF:sensor{i}_delta=sensor{i}_max,sensor{i}_min,-",
                  "AREA:sensor{i}_min#{color:06x}1e",
                  "LINE2:sensor{i}_min#{color:06x}:{label}",
                  "AREA:sensor{i}_delta#{color:06x}::STACK"
         ]
-        defs += list(map(lambda s: s.format(i = i, rrd = rrd,
+        defs += list(map(lambda s: s.format(i = i, rrd = rrd, ds = ds,
                 color = COLORS[i], label = label), d))
+    return [*COMMON_OPTS.split(),
+            *COLOR_OPTS.split(),
+            "--end", "now", "--start", start,
+            "--width", str(size[0]), "--height", str(size[1]),
+            *defs]
+
+
+def plot(rrds_and_labels, outdir, timespan="1d", name=None) -> bool:
+    log.debug("Plotting %s" % timespan)
+    filename = plot_filename(outdir, timespan, name)
+    start_time = time.monotonic()
     try:
-        completed = subprocess.run(["rrdtool", "graph",
-                filename,
-                *COMMON_OPTS.split(),
-                *COLOR_OPTS.split(),
-                "--end", "now", "--start", start,
-                "--width", str(SIZE[0]), "--height", str(SIZE[1]),
-                *defs],
-            stdout=subprocess.PIPE)
+        completed = subprocess.run(["rrdtool", "graph", filename,
+                                    *graph_args(rrds_and_labels, timespan)],
+                                   stdout=subprocess.PIPE)
         if completed.returncode != 0:
             log.error("RRD plot failed")
             log.debug(completed)
+            return False
     except FileNotFoundError as e:
         log.error(e)
+        return False
+    log.info("Rendered %s in %.0f ms" % (filename, (time.monotonic() - start_time) * 1000))
+    return True
+
+
+def last_updates(rrdfiles) -> Dict[str, Optional[int]]:
+    """Get the last update time of each RRD, or None if it can't be read"""
+    backend = RrdPipe(log=log)
+    updates = {}
+    try:
+        for rrdfile in rrdfiles:
+            try:
+                updates[rrdfile] = int(backend.run("last", rrdfile)[0])
+            except (RrdError, IndexError, ValueError) as e:
+                log.warning("Failed to read last update of %s: %s" % (rrdfile, e))
+                updates[rrdfile] = None
+    finally:
+        backend.stop()
+    return updates
+
+
+def plot_groups(groups: List[dict], outdir, jobs: Optional[int]):
+    """Render groups of RRDs in parallel. A plot is skipped if none of its RRDs have been
+    updated since it was last rendered."""
+    state_path = Path(outdir, STATE_FILE)
+    state = {}
+    if state_path.is_file():
+        with open(state_path) as f:
+            state = json.load(f)
+    rrdfiles = {split_ds(rrd)[0] for group in groups for rrd in group["rrd"]}
+    updates = last_updates(sorted(rrdfiles))
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {}
+        for group in groups:
+            rrds_and_labels = list(itertools.zip_longest(group["rrd"], group.get("labels", []),
+                                                         fillvalue="sensor"))
+            sources = {split_ds(rrd)[0]: updates[split_ds(rrd)[0]] for rrd in group["rrd"]}
+            for timespan in group.get("timespans", TIMESPANS):
+                filename = plot_filename(outdir, timespan, group["name"])
+                if None not in sources.values() and state.get(filename) == sources and \
+                        os.path.exists(filename):
+                    log.debug("%s is up to date" % filename)
+                    continue
+                future = executor.submit(plot, rrds_and_labels, outdir, timespan, group["name"])
+                futures[future] = (filename, sources)
+        for future in as_completed(futures):
+            filename, sources = futures[future]
+            if future.result():
+                state[filename] = sources
+    with open("%s.tmp" % state_path, "w") as f:
+        json.dump(state, f)
+    os.replace("%s.tmp" % state_path, state_path)
 
 
 def run():
     logging.basicConfig(level=logging.INFO)
 
     parser = argparse.ArgumentParser(description="Publish one-wire sensor values with MQTT")
-    parser.add_argument(nargs="+", dest="rrd", metavar="RRD", help="RRD files")
+    parser.add_argument(nargs="*", dest="rrd", metavar="RRD",
+                        help="RRD files, with the DS name as FILE:DS if it isn't 'value'")
     parser.add_argument("-l", action="append",
                         help="Data label (can be repeated)")
     parser.add_argument("--debug", default=False, action="store_true",
@@ -70,12 +156,27 @@ def run():
     parser.add_argument("--outdir", default=".", metavar="DIR", help="Output directory")
     parser.add_argument("-t", action="append",
                         help="Timespan to plot (can be repeated)")
+    parser.add_argument("--config", metavar="FILE",
+                        help="JSON file with a list of plot groups to render in parallel, as "
+                        '[{"name": NAME, "rrd": [RRD, ...], "labels": [LABEL, ...], "timespans": [TIMESPAN, ...]}]')
+    parser.add_argument("--jobs", metavar="N", type=int,
+                        help="Number of plots rendered at once with --config [default: number of CPUs]")
     args = parser.parse_args()
     
     if args.debug:
         logging.getLogger().setLevel('DEBUG')
 
-    timespans = ["1d", "1w", "1m", "1y"]
+    if args.config is not None:
+        with open(args.config) as f:
+            groups = json.load(f)
+        start_time = time.monotonic()
+        plot_groups(groups, args.outdir, args.jobs)
+        log.info("Done in %.1f s" % (time.monotonic() - start_time))
+        return
+    if not args.rrd:
+        parser.error("No RRD files given")
+
+    timespans = TIMESPANS
     if args.t is not None:
         timespans = args.t
     if args.l is None:
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+#
+# Render plots on request over HTTP
+#
+
+import argparse
+import hashlib
+import io
+import logging
+import os
+import re
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import List, Optional
+from urllib.parse import parse_qs, urlparse
+
+from . import plot_rrds, plot_sql, sample_db
+
+log = logging.getLogger('plot_server')
+
+MAX_SIZE = (4000, 2000)
+SERIES_PATTERN = re.compile(r'\w[\w.-]*(:\w+)?')
+
+
+class BadRequest(Exception):
+    pass
+
+
+class PlotParams:
+    """What to plot, parsed from the query string"""
+    def __init__(self, query: str):
+        qs = parse_qs(query)
+        self.series: List[str] = qs.get('series', [])
+        if not self.series:
+            raise BadRequest('No series')
+        for series in self.series:
+            if not SERIES_PATTERN.fullmatch(series):
+                raise BadRequest(f'Bad series name {series}')
+        labels = qs.get('label', [])
+        self.labels: List[str] = labels + self.series[len(labels):]
+        self.timespan = qs.get('timespan', ['1d'])[0]
+        # With a unit, as rrdtool wants it
+        if not re.fullmatch(r'\d+[hdwmy]', self.timespan):
+            raise BadRequest(f'Bad timespan {self.timespan}')
+        self.seconds = plot_sql.parse_timespan(self.timespan)
+        try:
+            self.size = (int(qs.get('width', [plot_rrds.SIZE[0]])[0]),
+                         int(qs.get('height', [plot_rrds.SIZE[1]])[0]))
+        except ValueError:
+            raise BadRequest('Bad size')
+        if not (0 < self.size[0] <= MAX_SIZE[0] and 0 < self.size[1] <= MAX_SIZE[1]):
+            raise BadRequest('Bad size')
+
+    def key(self) -> tuple:
+        return tuple(self.series), tuple(self.labels), self.timespan, self.size
+
+
+class RrdRenderer:
+    def __init__(self, rrd_path: str):
+        self.rrd_path = rrd_path
+
+    def version(self, params: PlotParams) -> Optional[tuple]:
+        """The modification times of the RRDs, or None if one is missing"""
+        mtimes = []
+        for series in params.series:
+            try:
+                mtimes.append(os.stat(Path(self.rrd_path, f'{plot_rrds.split_ds(series)[0]}.rrd')).st_mtime_ns)
+            except FileNotFoundError:
+                return None
+        return tuple(mtimes)
+
+    def render(self, params: PlotParams) -> bytes:
+        rrds_and_labels = []
+        for series, label in zip(params.series, params.labels):
+            name, ds = plot_rrds.split_ds(series)
+            rrds_and_labels.append((f'{self.rrd_path}/{name}.rrd:{ds}', label))
+        with tempfile.NamedTemporaryFile(suffix='.png') as f:
+            completed = subprocess.run(['rrdtool', 'graph', f.name,
+                                        *plot_rrds.graph_args(rrds_and_labels, params.timespan, params.size)],
+                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            if completed.returncode != 0:
+                raise RuntimeError(completed.stderr.decode(errors='replace').strip())
+            return f.read()
+
+
+class SqlRenderer:
+    """Renders plots from the mqtt_to_sql database. Matplotlib isn't thread safe, so one
+    plot is rendered at a time."""
+    def __init__(self, db_file: str):
+        self.db_file = db_file
+        self.lock = threading.Lock()
+
+    def version(self, params: PlotParams) -> Optional[tuple]:
+        """The newest per-minute rollup of each series, which changes with every sample written
+        to it, or None if a series is missing. Unlike the modification time of the database,
+        this stays the same while only other series are written."""
+        try:
+            db = sqlite3.connect(f'file:{self.db_file}?mode=ro', uri=True)
+        except sqlite3.Error:
+            return None
+        try:
+            rollups = []
+            for name in params.series:
+                cur = db.execute(f'SELECT rollup.time, rollup.sum, rollup.count '
+                                 f'FROM series LEFT JOIN rollup_{sample_db.ROLLUP_RESOLUTIONS[0]} AS rollup '
+                                 'ON rollup.series=series.id WHERE series.name=? '
+                                 'ORDER BY rollup.time DESC LIMIT 1', (name, ))
+                row = cur.fetchone()
+                if row is None:
+                    return None
+                rollups.append(row)
+            return tuple(rollups)
+        except sqlite3.Error:
+            return None
+        finally:
+            db.close()
+
+    def render(self, params: PlotParams) -> bytes:
+        out = io.BytesIO()
+        with self.lock:
+            db = sqlite3.connect(f'file:{self.db_file}?mode=ro', uri=True)
+            try:
+                plot_sql.plot_figure(db, list(zip(params.series, params.labels)), params.seconds, out,
+                                     (params.size[0] / 100, params.size[1] / 100))
+            finally:
+                db.close()
+        return out.getvalue()
+
+
+class PlotCache:
+    """Rendered plots, keyed by the plot parameters, the newest data of the series and the time.
+    Concurrent requests for the same plot wait for one rendering."""
+    def __init__(self, renderer, max_entries: int):
+        self.renderer = renderer
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries: OrderedDict[str, bytes] = OrderedDict()
+        self.pending: dict = {}
+
+    def etag(self, params: PlotParams) -> Optional[str]:
+        """Tag for the current version of a plot, or None if the data is missing"""
+        version = self.renderer.version(params)
+        if version is None:
+            return None
+        # Without new data the plot still moves along with the current time, so it is rendered
+        # again when the time axis has moved by about a pixel
+        resolution = max(params.seconds // params.size[0], 60)
+        key = repr((params.key(), version, int(time.time()) // resolution))
+        return '"%s"' % hashlib.sha1(key.encode()).hexdigest()
+
+    def get(self, etag: str, params: PlotParams) -> bytes:
+        with self.lock:
+            png = self.entries.get(etag)
+            if png is not None:
+                self.entries.move_to_end(etag)
+                return png
+            future = self.pending.get(etag)
+            owner = future is None
+            if owner:
+                future = self.pending[etag] = Future()
+        if not owner:
+            log.debug(f'Waiting for plot {etag} being rendered')
+            return future.result()
+        start_time = time.monotonic()
+        try:
+            png = self.renderer.render(params)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.pending[etag]
+        log.info(f'Rendered {params.key()} in {(time.monotonic() - start_time) * 1000:.0f} ms')
+        with self.lock:
+            self.entries[etag] = png
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        future.set_result(png)
+        return png
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        o = urlparse(self.path)
+        if o.path != '/plot.png':
+            self.send_error(404)
+            return
+        try:
+            params = PlotParams(o.query)
+        except BadRequest as e:
+            self.send_error(400, str(e))
+            return
+        cache: PlotCache = self.server.cache
+        etag = cache.etag(params)
+        if etag is None:
+            self.send_error(404, 'No such series')
+            return
+        if etag in self.headers.get('If-None-Match', ''):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        try:
+            png = cache.get(etag, params)
+        except Exception as e:
+            log.error(f'Failed to render {params.key()}: {e}')
+            self.send_error(500, 'Failed to render plot')
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(png)))
+        self.send_header('ETag', etag)
+        # Clients check back with the ETag every time
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(png)
+
+    def log_message(self, format, *args):
+        """Override from BaseHTTPRequestHandler"""
+        message = format % args
+        log.debug("%s - - [%s] %s" %
+                  (self.address_string(),
+                   self.log_date_time_string(),
+                   message))
+
+
+def run_http_server(port: int, cache: PlotCache):
+    httpd = ThreadingHTTPServer(('', port), RequestHandler)
+    httpd.cache = cache
+    log.info(f'Listening on port {port}')
+    httpd.serve_forever()
+
+
+def run():
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Render plots on request over HTTP')
+    parser.add_argument('--port', default=8080, type=int, help='HTTP server port')
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--rrd-path', metavar='PATH', default='.',
+                        help='Plot RRD files from this directory')
+    source.add_argument('--db', metavar='FILE', help='Plot from this SQLite database instead of RRDs')
+    parser.add_argument('--cache-size', metavar='N', type=int, default=64,
+                        help='Number of rendered plots to keep in memory')
+    parser.add_argument('--debug', default=False, action='store_true',
+                        help='Enable debug printouts')
+    args = parser.parse_args()
+
+    if args.debug:
+        logging.getLogger().setLevel('DEBUG')
+
+    if args.db is not None:
+        renderer = SqlRenderer(args.db)
+    else:
+        renderer = RrdRenderer(args.rrd_path)
+
+    try:
+        run_http_server(args.port, PlotCache(renderer, args.cache_size))
+    except KeyboardInterrupt:
+        log.info('Exit on CTRL-C')
+
+
+if __name__ == '__main__':
+    run()
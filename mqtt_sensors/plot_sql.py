@@ -5,20 +5,66 @@
 
 import argparse
 import itertools
+import json
 import logging
+import re
 import time
 import datetime
-from typing import List, Tuple
+from typing import Dict, List, Optional, Tuple
 import sqlite3
-import matplotlib.pyplot as plt
-import matplotlib as mpl
+import numpy as np
+
+from . import sample_db
 
 MAX_FORWARD_FILL = 3600
 BG_COLOR = '#332222'
+TIMESPANS = ['1d', '1w', '1m', '1y']
+# Time span suffixes, in seconds
+TIMESPAN_UNITS = {'h': 60*60, 'd': 24*60*60, 'w': 7*24*60*60, 'm': 31*24*60*60, 'y': 366*24*60*60}
 
 log = logging.getLogger('plot_sql')
 
 
+def parse_timespan(value: str) -> int:
+    """A number of seconds, or a number followed by h, d, w, m or y"""
+    match = re.fullmatch(r'(\d+)([hdwmy]?)', value)
+    if match is None:
+        raise ValueError(f'Bad time span {value}')
+    return int(match.group(1)) * TIMESPAN_UNITS.get(match.group(2), 1)
+
+
+def pyplot():
+    """Import matplotlib on first use, since it takes a while, with the non-interactive backend"""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.dates
+    import matplotlib.pyplot
+    return matplotlib, matplotlib.pyplot
+
+
+class SeriesCache:
+    """Series data read once for the widest time span, and sliced for narrower spans ending
+    at the same time. Kept per series and resolution."""
+    def __init__(self, db: sqlite3.Connection):
+        self.db = db
+        self.data: Dict[Tuple[int, Optional[int]], Tuple[int, int, int, np.ndarray, np.ndarray]] = {}
+
+    def read(self, series_id: int, start_time: int, end_time: int,
+             points: int = None) -> Tuple[int, np.ndarray, np.ndarray]:
+        resolution = None
+        if points is not None:
+            resolution = sample_db.rollup_resolution(self.db, series_id, end_time - start_time, points)
+        cached = self.data.get((series_id, resolution))
+        if cached is None or cached[0] > start_time or cached[1] < end_time:
+            cached = (start_time, end_time,
+                      *sample_db.read_series(self.db, series_id, start_time, end_time, points))
+            self.data[series_id, resolution] = cached
+        _, _, resolution, times, values = cached
+        first = np.searchsorted(times, start_time, side='left')
+        last = np.searchsorted(times, end_time, side='right')
+        return resolution, times[first:last], values[first:last]
+
+
 def get_series_id(db: sqlite3.Connection, name: str) -> int:
     cur = db.execute('SELECT id FROM series WHERE name=?', (name, ))
     result = cur.fetchone()
@@ -26,38 +72,64 @@ def get_series_id(db: sqlite3.Connection, name: str) -> int:
         return result[0]
 
 
-def plot_series(db: sqlite3.Connection, ax, series_name: str, label: str, start_time: int, end_time: int):
-    series_id = get_series_id(db, series_name)
+def downsample(times: np.ndarray, values: np.ndarray, start_time: int, end_time: int,
+               buckets: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Keep the first smallest and largest value in each of a number of equal time buckets.
+    This keeps the envelope of the data, with at most two points per bucket. The times must
+    be sorted."""
+    present = ~np.isnan(values)
+    times, values = times[present], values[present]
+    if len(times) == 0:
+        return times, values
+    bucket = (times - start_time) * buckets // max(end_time - start_time, 1)
+    first = np.flatnonzero(np.diff(bucket, prepend=bucket[0] - 1))
+    segment = np.repeat(np.arange(len(first)), np.diff(np.append(first, len(bucket))))
+    keep = []
+    for reduce in (np.minimum, np.maximum):
+        index = np.flatnonzero(values == reduce.reduceat(values, first)[segment])
+        keep.append(index[np.diff(segment[index], prepend=-1) != 0])
+    keep = np.union1d(*keep)
+    return times[keep], values[keep]
+
+
+def plot_series(cache: SeriesCache, ax, series_name: str, label: str, start_time: int, end_time: int,
+                points: int = None):
+    series_id = get_series_id(cache.db, series_name)
     if series_id is None:
         log.error(f'No such series {series_name}')
         return
-    cur = db.execute(f'SELECT (time/60*60) as time, value AS "{series_name}" FROM samples '
-                     'WHERE series=? AND time >= ? AND time <= ? ORDER BY time',
-                     (series_id, start_time - MAX_FORWARD_FILL, end_time + MAX_FORWARD_FILL))
-    data: List[Tuple[int, float]] = list(cur)
-    last_time = None
+    # Long time spans are plotted from the rollup tables, with about as many points as pixels
+    resolution, times, values = cache.read(series_id, start_time - MAX_FORWARD_FILL,
+                                           end_time + MAX_FORWARD_FILL, points)
+    log.debug(f'Plotting {len(times)} points of {series_name} at resolution {resolution}')
+    max_gap = max(MAX_FORWARD_FILL, resolution)
+    if points is not None and len(times) > 2 * points:
+        times, values = downsample(times, values, start_time - MAX_FORWARD_FILL,
+                                   end_time + MAX_FORWARD_FILL, points)
+        # The points kept in neighbouring buckets can be up to two buckets apart
+        max_gap = max(max_gap, 2 * (end_time - start_time + 2 * MAX_FORWARD_FILL) // points)
     # Insert dummy samples to inhibit lines that are too long
-    for i, (t, v) in enumerate(data):
-        if last_time is not None and t > last_time + MAX_FORWARD_FILL:
-            data.insert(i, (t-1, None))
-        last_time = t
-    ax.plot([datetime.datetime.utcfromtimestamp(t) for t, v in data],
-            [v for t, v in data],
-            '-', label=label)
-
-
-def plot(args):
-    series_and_labels = list(itertools.zip_longest(args.series, args.l, fillvalue="sensor"))
-
-    db = sqlite3.connect(f'file:{args.db}?mode=ro', uri=True)
-    end_time = int(time.time() // 60) * 60
-    start_time = end_time - args.time
+    gaps = np.flatnonzero(np.diff(times) > max_gap) + 1
+    times = np.insert(times, gaps, times[gaps] - 1)
+    values = np.insert(values, gaps, np.nan)
+    ax.plot(times.astype('datetime64[s]'), values, '-', label=label)
+
+
+def plot_figure(db: sqlite3.Connection, series_and_labels: List[Tuple[str, str]], time_span: int,
+                out, figsize=(9, 3), cache: SeriesCache = None, end_time: int = None):
+    """Plot series over the last time_span seconds, and save the figure to a file name or file object"""
+    mpl, plt = pyplot()
+    if cache is None:
+        cache = SeriesCache(db)
+    if end_time is None:
+        end_time = int(time.time() // 60) * 60
+    start_time = end_time - time_span
 
     hour_count = (end_time - start_time) // (60 * 60)
     day_count = hour_count // 24
 
     mpl.style.use('dark_background')
-    fig, ax = plt.subplots(facecolor=BG_COLOR, figsize=(9, 3))
+    fig, ax = plt.subplots(facecolor=BG_COLOR, figsize=figsize)
     ax.set_facecolor(BG_COLOR)
     tz = datetime.datetime.now().astimezone().tzinfo
     ax.xaxis_date(tz=tz)
@@ -69,27 +141,68 @@ def plot(args):
     ax.grid(color='#444444')
 
     for series_name, label in series_and_labels:
-        plot_series(db, ax, series_name, label, start_time, end_time)
+        plot_series(cache, ax, series_name, label, start_time, end_time,
+                    int(fig.get_figwidth() * fig.dpi))
 
     fig.legend(loc='upper center', ncol=len(series_and_labels), frameon=False)
-    plt.savefig(args.out, facecolor=BG_COLOR)
+    fig.savefig(out, facecolor=BG_COLOR)
+    plt.close(fig)
+
+
+def plot(args):
+    series_and_labels = list(itertools.zip_longest(args.series, args.l, fillvalue="sensor"))
+    db = sqlite3.connect(f'file:{args.db}?mode=ro', uri=True)
+    plot_figure(db, series_and_labels, args.time, args.out)
+
+
+def plot_batch(db: sqlite3.Connection, figures: List[dict], outdir: str):
+    """Render each figure for each of its time spans, widest first, so that the data read for
+    the widest span can be reused for the others"""
+    cache = SeriesCache(db)
+    end_time = int(time.time() // 60) * 60
+    for figure in figures:
+        series_and_labels = list(itertools.zip_longest(figure['series'], figure.get('labels', []),
+                                                       fillvalue="sensor"))
+        timespans = figure.get('timespans', TIMESPANS)
+        for timespan in sorted(timespans, key=parse_timespan, reverse=True):
+            filename = f"{outdir}/plot-{figure['name']}-{timespan}.png"
+            start_time = time.monotonic()
+            plot_figure(db, series_and_labels, parse_timespan(timespan), filename,
+                        cache=cache, end_time=end_time)
+            log.info(f'Rendered {filename} in {(time.monotonic() - start_time) * 1000:.0f} ms')
 
 
 def run():
     logging.basicConfig(level=logging.INFO)
 
     parser = argparse.ArgumentParser(description="Plot readings from a SQL database")
-    parser.add_argument(nargs="+", dest="series", metavar="SERIES", help="Data series")
+    parser.add_argument(nargs="*", dest="series", metavar="SERIES", help="Data series")
     parser.add_argument("-l", metavar="LABEL", action="append", help="Data label (can be repeated)")
     parser.add_argument("--db", metavar="FILE", default="samples.sqlite", help="SQLite database file")
-    parser.add_argument("--time", metavar="SECONDS", type=int, default=24*60*60, help="Time span to plot, in seconds")
+    parser.add_argument("--time", metavar="SECONDS", type=parse_timespan, default=24*60*60,
+                        help="Time span to plot, in seconds or with a unit (h, d, w, m, y)")
     parser.add_argument("--out", metavar="FILENAME", default="plot.png", help="Output filename")
+    parser.add_argument("--config", metavar="FILE",
+                        help="JSON file with a list of figures to render, as "
+                        '[{"name": NAME, "series": [SERIES, ...], "labels": [LABEL, ...], "timespans": [TIMESPAN, ...]}]')
+    parser.add_argument("--outdir", metavar="DIR", default=".", help="Output directory with --config")
     parser.add_argument("--debug", default=False, action="store_true", help="Enable debug printouts")
     args = parser.parse_args()
     
     if args.debug:
         logging.getLogger().setLevel('DEBUG')
 
+    if args.config is not None:
+        with open(args.config) as f:
+            figures = json.load(f)
+        db = sqlite3.connect(f'file:{args.db}?mode=ro', uri=True)
+        start_time = time.monotonic()
+        plot_batch(db, figures, args.outdir)
+        log.info(f'Done in {time.monotonic() - start_time:.1f} s')
+        return
+    if not args.series:
+        parser.error("No series given")
+
     if args.l is None:
         args.l = []
 
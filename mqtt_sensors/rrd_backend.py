@@ -0,0 +1,192 @@
+#
+# Ways of running rrdtool commands without starting a new rrdtool process for each one
+#
+
+import logging
+import os
+import socket
+import subprocess
+from contextlib import suppress
+from typing import Dict, List, Optional, Sequence
+
+
+class RrdError(Exception):
+    pass
+
+
+def quote(arg: str) -> str:
+    """Quote an argument for the rrdtool pipe mode tokenizer, which knows about quotes but
+    not about escapes"""
+    if not arg or any(c.isspace() for c in arg) or "'" in arg or '"' in arg:
+        return "'%s'" % arg if '"' in arg else '"%s"' % arg
+    return arg
+
+
+class RrdPipe:
+    """Runs rrdtool commands through one long-lived `rrdtool -` process, which is restarted
+    if it exits. Not thread safe."""
+    def __init__(self, command: Sequence[str] = ('rrdtool', ), log=logging.getLogger()):
+        self.command = [*command, '-']
+        self.log = log.getChild('rrdtool')
+        self.process: Optional[subprocess.Popen] = None
+
+    def start(self):
+        self.log.debug(f'Starting {" ".join(self.command)}')
+        try:
+            self.process = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                            text=True, bufsize=1)
+        except OSError as e:
+            raise RrdError(f'Failed to start rrdtool: {e}') from e
+
+    def stop(self):
+        if self.process is None:
+            return
+        self.process.stdin.close()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+    def run(self, *args: str) -> List[str]:
+        """Run an rrdtool command and return its output lines"""
+        line = ' '.join(map(quote, args)) + '\n'
+        if '\n' in line[:-1]:
+            raise RrdError('Newline in rrdtool argument')
+        for attempt in range(2):
+            if self.process is None or self.process.poll() is not None:
+                if self.process is not None:
+                    self.log.warning(f'rrdtool exited with code {self.process.returncode}, restarting')
+                self.start()
+            try:
+                self.process.stdin.write(line)
+                self.process.stdin.flush()
+                break
+            except BrokenPipeError:
+                # Died before taking the command, so it is safe to send it again
+                self.process.wait()
+        else:
+            raise RrdError('rrdtool keeps exiting')
+        output = []
+        while True:
+            response = self.process.stdout.readline()
+            if not response:
+                self.process.wait()
+                raise RrdError(f'rrdtool exited with code {self.process.returncode}')
+            if response.startswith('OK'):
+                return output
+            if response.startswith('ERROR:'):
+                raise RrdError(response[6:].strip())
+            output.append(response.rstrip('\n'))
+
+    def info(self, rrdfile: str) -> List[str]:
+        return self.run('info', rrdfile)
+
+    def flush(self, rrdfile: str):
+        """Write out any cached updates to the file"""
+        pass
+
+    def update(self, updates: Dict[str, List[str]]) -> List[str]:
+        """Add a list of timestamp:value strings to each RRD file. Errors are logged per file,
+        and the files that failed are returned."""
+        failed = []
+        for rrdfile, values in updates.items():
+            try:
+                self.run('update', rrdfile, *values)
+            except RrdError as e:
+                self.log.error(f'RRD update of {rrdfile} failed: {e}')
+                failed.append(rrdfile)
+        return failed
+
+
+class RrdCached(RrdPipe):
+    """Sends updates to rrdcached over its UNIX socket, as one BATCH per call. Other commands
+    still go through an rrdtool pipe."""
+    def __init__(self, address: str, command: Sequence[str] = ('rrdtool', ), log=logging.getLogger()):
+        super().__init__(command, log)
+        self.address = address[len('unix:'):] if address.startswith('unix:') else address
+        self.sock: Optional[socket.socket] = None
+        self.file = None
+
+    def connect(self):
+        self.log.debug(f'Connecting to rrdcached at {self.address}')
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(self.address)
+        except OSError:
+            self.sock.close()
+            self.sock = None
+            raise
+        self.file = self.sock.makefile('rw', encoding='utf-8', newline='\n')
+
+    def disconnect(self):
+        if self.sock is not None:
+            with suppress(OSError):
+                self.file.close()
+            self.sock.close()
+            self.sock = None
+            self.file = None
+
+    def stop(self):
+        self.disconnect()
+        super().stop()
+
+    def info(self, rrdfile: str) -> List[str]:
+        # Flushes the file first, so that the last update time is up to date
+        return self.run('info', '--daemon', f'unix:{self.address}', rrdfile)
+
+    def flush(self, rrdfile: str):
+        self.run('flushcached', '--daemon', f'unix:{self.address}', rrdfile)
+
+    def response(self) -> List[str]:
+        """Read a status line, and the number of lines it announces"""
+        status = self.file.readline()
+        if not status:
+            raise OSError('rrdcached closed the connection')
+        count, _, message = status.rstrip('\n').partition(' ')
+        count = int(count)
+        if count < 0:
+            raise RrdError(message)
+        return [message] + [self.file.readline().rstrip('\n') for _ in range(count)]
+
+    def start_batch(self):
+        if self.sock is not None:
+            try:
+                self.file.write('BATCH\n')
+                self.file.flush()
+                self.response()
+                return
+            except OSError:
+                # The daemon may have been restarted since the last batch. Nothing has been
+                # sent yet, so try again on a new connection.
+                self.disconnect()
+        self.connect()
+        self.file.write('BATCH\n')
+        self.file.flush()
+        self.response()
+
+    def update(self, updates: Dict[str, List[str]]) -> List[str]:
+        files = list(updates)
+        failed = []
+        if not files:
+            return failed
+        try:
+            self.start_batch()
+            for rrdfile in files:
+                # The daemon resolves relative paths against its own working directory
+                self.file.write(' '.join(['UPDATE', os.path.abspath(rrdfile), *updates[rrdfile]]) + '\n')
+            self.file.write('.\n')
+            self.file.flush()
+            # One line per failed command, starting with the command number
+            for error in self.response()[1:]:
+                number, _, message = error.partition(' ')
+                index = int(number) - 1
+                rrdfile = files[index] if 0 <= index < len(files) else f'command {number}'
+                self.log.error(f'RRD update of {rrdfile} failed: {message}')
+                failed.append(rrdfile)
+        except (OSError, ValueError, RrdError) as e:
+            self.log.error(f'rrdcached update failed: {e}')
+            self.disconnect()
+            return files
+        return failed
@@ -0,0 +1,41 @@
+#
+# Compressed encoding of sample blocks
+#
+# Timestamps are stored as delta-of-delta values, which are all zero for a series sampled at
+# a fixed interval. Values are XORed with the previous value, Gorilla style, so that slowly
+# changing readings leave mostly zero bits. Both are byte-shuffled, putting the bytes of equal
+# significance next to each other, and compressed with zlib.
+#
+
+import zlib
+from typing import Tuple
+
+import numpy as np
+
+
+def shuffle(data: np.ndarray) -> bytes:
+    return zlib.compress(data.view(np.uint8).reshape(-1, 8).T.tobytes())
+
+
+def unshuffle(blob: bytes, count: int) -> np.ndarray:
+    data = np.frombuffer(zlib.decompress(blob), dtype=np.uint8).reshape(8, count)
+    return np.ascontiguousarray(data.T).view('<u8').reshape(count)
+
+
+def encode(times: np.ndarray, values: np.ndarray) -> Tuple[bytes, bytes]:
+    """Encode sorted int64 timestamps and float64 values"""
+    times = times.astype('<i8')
+    dod = np.diff(np.diff(times, prepend=0), prepend=0)
+    # Zigzag encoding keeps small negative numbers small
+    zigzag = (dod << 1) ^ (dod >> 63)
+    bits = values.astype('<f8').view('<u8')
+    xored = bits ^ np.concatenate((np.zeros(1, '<u8'), bits[:-1]))
+    return shuffle(zigzag), shuffle(xored)
+
+
+def decode(time_data: bytes, value_data: bytes, count: int) -> Tuple[np.ndarray, np.ndarray]:
+    zigzag = unshuffle(time_data, count)
+    dod = (zigzag >> 1).astype('<i8') ^ -(zigzag & 1).astype('<i8')
+    times = np.cumsum(np.cumsum(dod))
+    values = np.bitwise_xor.accumulate(unshuffle(value_data, count)).view('<f8')
+    return times, values
@@ -0,0 +1,456 @@
+#
+# Schema and migrations for the samples database
+#
+
+import datetime
+import logging
+import os
+import sqlite3
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import suppress
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from . import sample_blocks
+
+# Version 1: samples clustered by (series, time)
+# Version 2: rollup tables
+# Version 3: table of partition files
+# Version 4: compressed sample blocks
+# Version 5: cold flag on partitions
+SCHEMA_VERSION = 5
+# Rollup table resolutions, in seconds
+ROLLUP_RESOLUTIONS = (60, 60*60, 24*60*60)
+# Rows moved per migration step
+MIGRATION_CHUNK = 10000
+PARTITION_SPANS = ('day', 'week', 'month', 'year')
+# Partitions kept attached to the writer's connection
+MAX_ATTACHED = 4
+# Time span of each compressed block
+BLOCK_SPAN = 24*60*60
+# Samples of one series from start to end (inclusive), encoded by sample_blocks
+BLOCKS_TABLE = '(series INTEGER, start INTEGER, end INTEGER, count INTEGER, ' \
+               'time_data BLOB, value_data BLOB, PRIMARY KEY(series, start)) WITHOUT ROWID'
+
+log = logging.getLogger('sample_db')
+
+
+def table_exists(db: sqlite3.Connection, name: str, schema='main') -> bool:
+    cur = db.execute(f"SELECT 1 FROM {schema}.sqlite_master WHERE type='table' AND name=?", (name, ))
+    return cur.fetchone() is not None
+
+
+def create_schema(db: sqlite3.Connection):
+    """Create or upgrade the schema. Moving existing data to the new layout is done in
+    small steps by maintenance_step(), so ingest can continue in the meantime."""
+    db.execute('BEGIN')
+    version = db.execute('PRAGMA user_version').fetchone()[0]
+    db.execute('CREATE TABLE IF NOT EXISTS series (id INTEGER PRIMARY KEY, name TEXT UNIQUE);')
+    if version < 1:
+        if table_exists(db, 'samples'):
+            log.info('Migrating samples to schema version 1')
+            db.execute('ALTER TABLE samples RENAME TO samples_old')
+        # Keeping the rows in (series, time) order makes range queries for a series cheap
+        db.execute('CREATE TABLE samples '
+                   '(series INTEGER, time INTEGER, value REAL, '
+                   'PRIMARY KEY(series, time), '
+                   'FOREIGN KEY(series) REFERENCES series(id)) WITHOUT ROWID;')
+    if version < 2:
+        # min/max/sum/count of the samples in each interval, like the RRAs in mqtt_to_rrd
+        for resolution in ROLLUP_RESOLUTIONS:
+            db.execute(f'CREATE TABLE rollup_{resolution} '
+                       '(series INTEGER, time INTEGER, min REAL, max REAL, sum REAL, count INTEGER, '
+                       'PRIMARY KEY(series, time)) WITHOUT ROWID;')
+        # Series whose rollups have not yet been computed from existing samples
+        db.execute('CREATE TABLE rollup_backfill (series INTEGER PRIMARY KEY);')
+        db.execute('INSERT INTO rollup_backfill SELECT id FROM series')
+    if version < 3:
+        # Files holding the raw samples of a time span, start inclusive and end exclusive
+        db.execute('CREATE TABLE partitions (name TEXT PRIMARY KEY, start INTEGER, end INTEGER);')
+    if version < 4:
+        db.execute(f'CREATE TABLE blocks {BLOCKS_TABLE};')
+    if version < 5:
+        # Set when a partition has been compacted and made read-only. File permissions don't
+        # tell, since they don't apply to root.
+        db.execute('ALTER TABLE partitions ADD COLUMN cold INTEGER NOT NULL DEFAULT 0;')
+    db.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+    db.commit()
+
+
+def migrate_samples(db: sqlite3.Connection) -> bool:
+    """Move one chunk of rows from the old samples table"""
+    cur = db.execute('SELECT max(rowid) FROM (SELECT rowid FROM samples_old ORDER BY rowid LIMIT ?)',
+                     (MIGRATION_CHUNK, ))
+    last_rowid = cur.fetchone()[0]
+    if last_rowid is None:
+        db.execute('DROP TABLE samples_old')
+        db.commit()
+        log.info('Migration of samples done')
+        return True
+    # Samples written since the migration started take precedence
+    db.execute('INSERT OR IGNORE INTO samples (series, time, value) '
+               'SELECT series, time, value FROM samples_old WHERE rowid <= ?', (last_rowid, ))
+    db.execute('DELETE FROM samples_old WHERE rowid <= ?', (last_rowid, ))
+    db.commit()
+    return True
+
+
+def insert_samples(db: sqlite3.Connection, samples: Iterable[Tuple[int, int, float]], schema='main',
+                   replace=True) -> List[Tuple[int, int, float]]:
+    """Insert (time, series, value) samples. Samples that are already there get the new value if
+    replace is set. Returns the samples that were added, which are the ones to add to the rollups."""
+    added = []
+    existing = []
+    for sample in samples:
+        if db.execute(f'INSERT OR IGNORE INTO {schema}.samples (time, series, value) VALUES (?, ?, ?)',
+                      sample).rowcount:
+            added.append(sample)
+        else:
+            existing.append(sample)
+    if replace and existing:
+        db.executemany(f'UPDATE {schema}.samples SET value=? WHERE series=? AND time=?',
+                       [(value, series_id, timestamp) for timestamp, series_id, value in existing])
+    return added
+
+
+def update_rollups(db: sqlite3.Connection, samples: Iterable[Tuple[int, int, float]]):
+    """Add (time, series, value) samples to the rollup tables"""
+    for resolution in ROLLUP_RESOLUTIONS:
+        # Aggregate the batch first, to do one upsert per interval rather than per sample
+        buckets: Dict[Tuple[int, int], List[float]] = defaultdict(list)
+        for timestamp, series_id, value in samples:
+            buckets[series_id, timestamp // resolution * resolution].append(value)
+        db.executemany(f'INSERT INTO rollup_{resolution} (series, time, min, max, sum, count) '
+                       'VALUES (?, ?, ?, ?, ?, ?) '
+                       'ON CONFLICT(series, time) DO UPDATE SET '
+                       'min=min(min, excluded.min), max=max(max, excluded.max), '
+                       'sum=sum+excluded.sum, count=count+excluded.count',
+                       [(series_id, bucket, min(values), max(values), sum(values), len(values))
+                        for (series_id, bucket), values in buckets.items()])
+
+
+def backfill_rollups(db: sqlite3.Connection) -> bool:
+    """Compute the rollups of one series from its samples. Returns False when done."""
+    result = db.execute('SELECT series FROM rollup_backfill LIMIT 1').fetchone()
+    if result is None:
+        return False
+    series_id = result[0]
+    for resolution in ROLLUP_RESOLUTIONS:
+        db.execute(f'INSERT OR REPLACE INTO rollup_{resolution} (series, time, min, max, sum, count) '
+                   f'SELECT series, time / {resolution} * {resolution} AS bucket, '
+                   'min(value), max(value), sum(value), count(value) '
+                   'FROM samples WHERE series=? GROUP BY bucket', (series_id, ))
+    db.execute('DELETE FROM rollup_backfill WHERE series=?', (series_id, ))
+    db.commit()
+    log.debug(f'Computed rollups for series {series_id}')
+    return True
+
+
+def compact_block(db: sqlite3.Connection, schema: str, series_id: int, before_time: int) -> bool:
+    """Move the oldest block span of samples of a series before the given time into the
+    blocks table. Returns False if there was nothing to move."""
+    first_time = db.execute(f'SELECT min(time) FROM {schema}.samples WHERE series=?',
+                            (series_id, )).fetchone()[0]
+    if first_time is None or first_time >= before_time:
+        return False
+    start = first_time // BLOCK_SPAN * BLOCK_SPAN
+    end = min(start + BLOCK_SPAN, before_time)
+    rows = db.execute(f'SELECT time, value FROM {schema}.samples '
+                      'WHERE series=? AND time >= ? AND time < ? ORDER BY time',
+                      (series_id, start, end)).fetchall()
+    times = np.array([t for t, _ in rows], dtype=np.int64)
+    values = np.array([v for _, v in rows], dtype=np.float64)
+    existing = db.execute(f'SELECT count, time_data, value_data FROM {schema}.blocks WHERE series=? AND start=?',
+                          (series_id, start)).fetchone()
+    if existing is not None:
+        # Samples that arrived after the block was written
+        old_times, old_values = sample_blocks.decode(existing[1], existing[2], existing[0])
+        times = np.concatenate((old_times, times))
+        values = np.concatenate((old_values, values))
+        order = np.argsort(times, kind='stable')
+        times, values = times[order], values[order]
+    time_data, value_data = sample_blocks.encode(times, values)
+    db.execute(f'INSERT OR REPLACE INTO {schema}.blocks (series, start, end, count, time_data, value_data) '
+               'VALUES (?, ?, ?, ?, ?, ?)',
+               (series_id, start, int(times[-1]), len(times), time_data, value_data))
+    db.execute(f'DELETE FROM {schema}.samples WHERE series=? AND time >= ? AND time < ?',
+               (series_id, start, end))
+    return True
+
+
+def compact_samples(db: sqlite3.Connection, schema: str, before_time: int) -> bool:
+    """Compact one block of samples before the given time. Returns False when done."""
+    for series_id, in db.execute('SELECT id FROM series').fetchall():
+        if compact_block(db, schema, series_id, before_time):
+            db.commit()
+            return True
+    return False
+
+
+def maintenance_step(db: sqlite3.Connection, compact_before: int = None) -> bool:
+    """Do a small piece of background work. Returns False when there is nothing left to do."""
+    if table_exists(db, 'samples_old'):
+        return migrate_samples(db)
+    if backfill_rollups(db):
+        return True
+    if compact_before is not None:
+        return compact_samples(db, 'main', compact_before // BLOCK_SPAN * BLOCK_SPAN)
+    return False
+
+
+def samples_source(db: sqlite3.Connection) -> str:
+    """Table expression for reading samples, including those not yet migrated"""
+    if table_exists(db, 'samples_old'):
+        return '(SELECT series, time, value FROM samples ' \
+               'UNION ALL SELECT series, time, value FROM samples_old)'
+    return 'samples'
+
+
+def rollup_resolution(db: sqlite3.Connection, series_id: int, span: int, points: int) -> Optional[int]:
+    """The coarsest rollup resolution that gives at least the given number of points over
+    the time span, or None if only the raw samples will do"""
+    if not table_exists(db, 'rollup_backfill') or \
+            db.execute('SELECT 1 FROM rollup_backfill WHERE series=?', (series_id, )).fetchone():
+        return None
+    for resolution in reversed(ROLLUP_RESOLUTIONS):
+        if span // resolution >= points:
+            return resolution
+    return None
+
+
+def read_series(db: sqlite3.Connection, series_id: int, start_time: int, end_time: int,
+                points: int = None) -> Tuple[int, np.ndarray, np.ndarray]:
+    """Read the times and values of a series into arrays. When points is given, the average values
+    from the coarsest rollup that still fills that many points are returned instead of the raw
+    samples. Returns the resolution of the data (0 for raw samples), the times and the values."""
+    resolution = None
+    if points is not None:
+        resolution = rollup_resolution(db, series_id, end_time - start_time, points)
+    if resolution is None:
+        return (0, *read_range(db, series_id, start_time, end_time))
+    rows = query_rollup(db, series_id, resolution, start_time, end_time).fetchall()
+    return (resolution, np.array([t for t, _ in rows], dtype=np.int64),
+            np.array([v for _, v in rows], dtype=np.float64))
+
+
+def query_rollup(db: sqlite3.Connection, series_id: int, resolution: int,
+                 start_time: int, end_time: int) -> sqlite3.Cursor:
+    """Query (time, average) rows from one of the rollup tables"""
+    return db.execute(f'SELECT time, sum / count FROM rollup_{resolution} '
+                      'WHERE series=? AND time >= ? AND time <= ? ORDER BY time',
+                      (series_id, start_time, end_time))
+
+
+def query_samples(db: sqlite3.Connection, series_id: int, start_time: int,
+                  end_time: int) -> Iterator[Tuple[int, float]]:
+    """Query raw (time, value) rows for a series"""
+    times, values = read_range(db, series_id, start_time, end_time)
+    return zip(times.tolist(), values.tolist())
+
+
+def read_range(db: sqlite3.Connection, series_id: int, start_time: int,
+               end_time: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Read the raw samples of a series into arrays of times and values, sorted by time.
+    Samples are read from the main database and from any partition files overlapping the
+    time range, from both the compressed blocks and the samples tables."""
+    parts = [read_schema(db, 'main', samples_source(db), series_id, start_time, end_time)]
+    if table_exists(db, 'partitions'):
+        for _ in attached_partitions(db, start_time, end_time):
+            parts.append(read_schema(db, 'part', 'part.samples', series_id, start_time, end_time))
+    times = np.concatenate([t for part in parts for t, _ in part])
+    values = np.concatenate([v for part in parts for _, v in part])
+    order = np.argsort(times, kind='stable')
+    return times[order], values[order]
+
+
+def read_schema(db: sqlite3.Connection, schema: str, source: str, series_id: int, start_time: int,
+                end_time: int) -> List[Tuple[np.ndarray, np.ndarray]]:
+    parts = []
+    if table_exists(db, 'blocks', schema):
+        cur = db.execute(f'SELECT count, time_data, value_data FROM {schema}.blocks '
+                         'WHERE series=? AND start <= ? AND end >= ? ORDER BY start',
+                         (series_id, end_time, start_time))
+        for count, time_data, value_data in cur.fetchall():
+            times, values = sample_blocks.decode(time_data, value_data, count)
+            in_range = (times >= start_time) & (times <= end_time)
+            parts.append((times[in_range], values[in_range]))
+    rows = db.execute(f'SELECT time, value FROM {source} '
+                      'WHERE series=? AND time >= ? AND time <= ? ORDER BY time',
+                      (series_id, start_time, end_time)).fetchall()
+    parts.append((np.array([t for t, _ in rows], dtype=np.int64),
+                  np.array([v for _, v in rows], dtype=np.float64)))
+    return parts
+
+
+def first_time(db: sqlite3.Connection, series_id: int) -> Optional[int]:
+    """The time of the first raw sample of a series, or None if it has none. Unlike the
+    rollups, this doesn't depend on the rollups having been backfilled."""
+    first = schema_first_time(db, 'main', samples_source(db), series_id)
+    if table_exists(db, 'partitions'):
+        # Partitions are in time order, so the first one with samples has the first of them
+        for _ in attached_partitions(db, -2**63, 2**63 - 1):
+            part_first = schema_first_time(db, 'part', 'part.samples', series_id)
+            if part_first is not None:
+                return part_first if first is None else min(first, part_first)
+    return first
+
+
+def schema_first_time(db: sqlite3.Connection, schema: str, source: str, series_id: int) -> Optional[int]:
+    times = [db.execute(f'SELECT min(time) FROM {source} WHERE series=?', (series_id, )).fetchone()[0]]
+    if table_exists(db, 'blocks', schema):
+        row = db.execute(f'SELECT count, time_data, value_data FROM {schema}.blocks '
+                         'WHERE series=? ORDER BY start LIMIT 1', (series_id, )).fetchone()
+        if row is not None:
+            count, time_data, value_data = row
+            times.append(int(sample_blocks.decode(time_data, value_data, count)[0][0]))
+    times = [t for t in times if t is not None]
+    return min(times) if times else None
+
+
+def attached_partitions(db: sqlite3.Connection, start_time: int, end_time: int) -> Iterator[str]:
+    """Attach each partition overlapping the time range in turn, as 'part'. No statement may be
+    running on the connection while iterating."""
+    directory = main_db_path(db).parent
+    cur = db.execute('SELECT name FROM partitions WHERE start <= ? AND end > ? ORDER BY start',
+                     (end_time, start_time))
+    for name, in cur.fetchall():
+        path = directory / name
+        if not path.is_file():
+            log.warning(f'Missing partition {path}')
+            continue
+        db.execute('ATTACH DATABASE ? AS part', (str(path), ))
+        try:
+            yield name
+        finally:
+            db.execute('DETACH DATABASE part')
+
+
+def main_db_path(db: sqlite3.Connection) -> Path:
+    for _, name, filename in db.execute('PRAGMA database_list'):
+        if name == 'main':
+            return Path(filename)
+
+
+def partition_bounds(timestamp: int, span: str) -> Tuple[str, int, int]:
+    """Label, start and end of the partition holding a timestamp"""
+    t = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+    start = t.replace(hour=0, minute=0, second=0, microsecond=0)
+    if span == 'day':
+        end = start + datetime.timedelta(days=1)
+        label = start.strftime('%Y-%m-%d')
+    elif span == 'week':
+        start -= datetime.timedelta(days=start.weekday())
+        end = start + datetime.timedelta(days=7)
+        label = start.strftime('%G-W%V')
+    elif span == 'month':
+        start = start.replace(day=1)
+        end = (start + datetime.timedelta(days=32)).replace(day=1)
+        label = start.strftime('%Y-%m')
+    elif span == 'year':
+        start = start.replace(month=1, day=1)
+        end = start.replace(year=start.year + 1)
+        label = start.strftime('%Y')
+    else:
+        raise ValueError(f'Unknown partition span {span}')
+    return label, int(start.timestamp()), int(end.timestamp())
+
+
+class PartitionWriter:
+    """Routes raw samples to one database file per time span, next to the main database.
+    Partitions are attached to the main connection while they are being written to.
+
+    Partitions that ended more than cold_after seconds ago are made read-only, and samples
+    for them are no longer stored. With a retention time, older partition files are deleted.
+    The rollup tables stay in the main database and keep the long-term history."""
+    def __init__(self, db: sqlite3.Connection, span: str, cold_after: float, retention: Optional[float]):
+        self.db = db
+        self.span = span
+        self.cold_after = cold_after
+        self.retention = retention
+        path = main_db_path(db)
+        self.directory = path.parent
+        self.stem = path.stem
+        self.suffix = path.suffix
+        # Partition file name to schema name
+        self.attached: Dict[str, str] = OrderedDict()
+
+    def file_name(self, label: str) -> str:
+        return f'{self.stem}-{label}{self.suffix}'
+
+    def attach(self, timestamps: Iterable[int]):
+        """Attach the partitions for a batch of samples. Must be called outside of a transaction."""
+        cold_before = time.time() - self.cold_after
+        names = set()
+        for timestamp in timestamps:
+            label, _, end = partition_bounds(timestamp, self.span)
+            if end >= cold_before:
+                names.add(self.file_name(label))
+        for name in list(self.attached):
+            if len(self.attached) + len(names - self.attached.keys()) <= MAX_ATTACHED:
+                break
+            if name not in names:
+                self.detach(name)
+        for name in names:
+            if name in self.attached:
+                self.attached.move_to_end(name)
+                continue
+            schema = 'p_' + name.replace('-', '_').replace('.', '_')
+            self.db.execute('ATTACH DATABASE ? AS ' + schema, (str(self.directory / name), ))
+            self.db.execute(f'PRAGMA {schema}.journal_mode=WAL')
+            self.db.execute(f'CREATE TABLE IF NOT EXISTS {schema}.samples '
+                            '(series INTEGER, time INTEGER, value REAL, '
+                            'PRIMARY KEY(series, time)) WITHOUT ROWID;')
+            self.attached[name] = schema
+
+    def detach(self, name: str):
+        with suppress(KeyError):
+            self.db.execute(f'DETACH DATABASE {self.attached.pop(name)}')
+
+    def insert(self, samples: List[Tuple[int, int, float]]) -> List[Tuple[int, int, float]]:
+        """Insert (time, series, value) samples. The partitions must have been attached.
+        Returns the samples that were added, like insert_samples()."""
+        added = []
+        cold_before = time.time() - self.cold_after
+        groups: Dict[Tuple[str, int, int], List[Tuple[int, int, float]]] = defaultdict(list)
+        for sample in samples:
+            groups[partition_bounds(sample[0], self.span)].append(sample)
+        for (label, start, end), rows in groups.items():
+            if end < cold_before:
+                log.warning(f'Dropped {len(rows)} samples for cold partition {label}')
+                continue
+            name = self.file_name(label)
+            self.db.execute('INSERT OR IGNORE INTO partitions (name, start, end) VALUES (?, ?, ?)',
+                            (name, start, end))
+            added += insert_samples(self.db, rows, self.attached[name])
+        return added
+
+    def expire(self):
+        """Make old partitions read-only and delete those past the retention time"""
+        now = time.time()
+        cur = self.db.execute('SELECT name, end, cold FROM partitions WHERE end < ?', (now - self.cold_after, ))
+        for name, end, cold in cur.fetchall():
+            path = self.directory / name
+            self.detach(name)
+            if self.retention is not None and end < now - self.retention:
+                log.info(f'Deleting partition {name}')
+                self.db.execute('DELETE FROM partitions WHERE name=?', (name, ))
+                self.db.commit()
+                for suffix in ('', '-wal', '-shm'):
+                    with suppress(FileNotFoundError):
+                        os.unlink(f'{path}{suffix}')
+            elif not cold and path.is_file():
+                log.info(f'Compacting partition {name} and making it read-only')
+                self.db.execute('ATTACH DATABASE ? AS cold', (str(path), ))
+                self.db.execute(f'CREATE TABLE IF NOT EXISTS cold.blocks {BLOCKS_TABLE};')
+                while compact_samples(self.db, 'cold', end):
+                    pass
+                self.db.execute('VACUUM cold')
+                # Readers can't open a read-only database in WAL mode
+                self.db.execute('PRAGMA cold.journal_mode=DELETE')
+                self.db.execute('DETACH DATABASE cold')
+                path.chmod(0o444)
+                self.db.execute('UPDATE partitions SET cold=1 WHERE name=?', (name, ))
+                self.db.commit()
@@ -4,16 +4,31 @@
 #
 
 import argparse
+import http.client
 import logging
 import time
-from collections import OrderedDict
-import datetime
-from typing import List, Dict, Tuple
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Optional, Tuple
 import sqlite3
 
-import influxdb_client
-from influxdb_client import InfluxDBClient, Point, WritePrecision
-from influxdb_client.client.write_api import ASYNCHRONOUS
+import numpy as np
+
+from . import sample_db
+from .checkpoint import Checkpoint
+from .influx import InfluxWriter, sample_line
+
+# Time span of raw samples read at a time
+CHUNK_SPAN = 24*60*60
+# Lines per write request
+BATCH_LINES = 5000
+# Attempts for each write request, and the time to wait after the first failed one, doubled
+# after each further failure [seconds]
+WRITE_ATTEMPTS = 5
+RETRY_DELAY = 1.0
+
+log = logging.getLogger('sql_to_influxdb')
+
 
 def get_series_id(db: sqlite3.Connection, name: str) -> int:
     cur = db.execute('SELECT id FROM series WHERE name=?', (name, ))
@@ -22,52 +37,135 @@ def get_series_id(db: sqlite3.Connection, name: str) -> int:
         return result[0]
 
 
-def export_series(db: sqlite3.Connection, write_api: influxdb_client.WriteApi, bucket: str, org: str, series_name: str, start_time: int, end_time: int):
-    series_id = get_series_id(db, series_name)
-    if series_id is None:
-        log.error(f'No such series {series_name}')
-        return
-    cur = db.execute(f'SELECT (time/60*60) as time, value AS "{series_name}" FROM samples '
-                     'WHERE series=? AND time >= ? AND time <= ? ORDER BY time',
-                     (series_id, start_time, end_time))
-    data: List[Tuple[int, float]] = list(cur)
-    for timestamp, value in data:
-        point = Point('sample') \
-            .field(series_name, float(value)) \
-            .tag('series', series_name) \
-            .time(timestamp, WritePrecision.S)
-        write_api.write(bucket, org, point)
-    log.info(f'Wrote {len(data)} samples')
+def write_lines(writer: InfluxWriter, lines: List[str]):
+    """Write lines, trying again after server errors and failed connections. Requests that
+    Influxdb rejects are not tried again."""
+    delay = RETRY_DELAY
+    for attempt in range(1, WRITE_ATTEMPTS + 1):
+        try:
+            writer.write(lines)
+            return
+        except urllib.error.HTTPError as e:
+            if (e.code < 500 and e.code != 429) or attempt == WRITE_ATTEMPTS:
+                raise
+            log.warning(f'Failed to write {len(lines)} lines: {e}, retrying in {delay:.1f} s')
+        except (urllib.error.URLError, http.client.HTTPException, OSError) as e:
+            if attempt == WRITE_ATTEMPTS:
+                raise
+            log.warning(f'Failed to write {len(lines)} lines: {e!r}, retrying in {delay:.1f} s')
+        time.sleep(delay)
+        delay *= 2
+
+
+def read_chunks(db: sqlite3.Connection, series_id: int, start_time: int, end_time: int,
+                resolution: int = None) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """Read the samples, or the averages at a rollup resolution, a part at a time"""
+    if resolution is not None:
+        cur = sample_db.query_rollup(db, series_id, resolution, start_time, end_time)
+        while True:
+            rows = cur.fetchmany(BATCH_LINES)
+            if not rows:
+                return
+            yield (np.array([t for t, _ in rows], dtype=np.int64),
+                   np.array([v for _, v in rows], dtype=np.float64))
+    for chunk_start in range(start_time, end_time + 1, CHUNK_SPAN):
+        yield sample_db.read_range(db, series_id, chunk_start, min(chunk_start + CHUNK_SPAN - 1, end_time))
+
+
+def export_series(db_file: str, writer: InfluxWriter, checkpoint: Checkpoint, series_name: str,
+                  start_time: int, end_time: int, resolution: int = None) -> int:
+    """Export the samples of a series newer than the last exported one. Returns the number of
+    samples written."""
+    db = sqlite3.connect(f'file:{db_file}?mode=ro', uri=True)
+    try:
+        series_id = get_series_id(db, series_name)
+        if series_id is None:
+            log.error(f'No such series {series_name}')
+            return 0
+        key = f'{series_name}/{resolution or "raw"}'
+        last_exported = checkpoint.get(key)
+        if last_exported is not None:
+            start_time = last_exported + 1
+        if resolution is not None:
+            # The newest interval isn't complete yet
+            end_time = end_time // resolution * resolution - 1
+        count = 0
+        lines: List[str] = []
+        last_time: Optional[int] = None
+        for times, values in read_chunks(db, series_id, start_time, end_time, resolution):
+            present = ~np.isnan(values)
+            stamps = times[present] if resolution is not None else times[present] // 60 * 60
+            lines += map(sample_line, [series_name] * len(stamps), stamps.tolist(), values[present].tolist())
+            if len(times):
+                last_time = int(times[-1])
+            if len(lines) >= BATCH_LINES:
+                write_lines(writer, lines)
+                count += len(lines)
+                lines = []
+                checkpoint.set(key, last_time)
+        if lines:
+            write_lines(writer, lines)
+            count += len(lines)
+        if last_time is not None:
+            checkpoint.set(key, last_time)
+        return count
+    finally:
+        db.close()
 
 
 def export(args):
-    db = sqlite3.connect(f'file:{args.db}?mode=ro', uri=True)
     end_time = int(time.time() // 60) * 60
     start_time = end_time - args.time
+    writer = InfluxWriter(args.url, args.org, args.bucket, args.token)
+    checkpoint = Checkpoint(args.checkpoint)
 
-    with InfluxDBClient(args.url, token=args.token, org=args.org) as influx:
-        with influx.write_api() as write_api:
-            for series_name in args.series:
-                log.info(f'Exporting series {series_name}')
-                export_series(db, write_api, args.bucket, args.org, series_name, start_time, end_time)
+    def export_one(series_name: str) -> int:
+        start = time.monotonic()
+        try:
+            count = export_series(args.db, writer, checkpoint, series_name, start_time, end_time,
+                                  args.resolution)
+        except (urllib.error.URLError, http.client.HTTPException, OSError, sqlite3.Error) as e:
+            log.error(f'Exporting {series_name} failed: {e}')
+            return 0
+        elapsed = time.monotonic() - start
+        log.info(f'Wrote {count} samples of {series_name} in {elapsed:.1f} s '
+                 f'({count / max(elapsed, 1e-3):.0f} rows/s)')
+        return count
 
+    start = time.monotonic()
+    # Each series is read on its own connection
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        total = sum(executor.map(export_one, args.series))
+    elapsed = time.monotonic() - start
+    log.info(f'Wrote {total} samples in {elapsed:.1f} s ({total / max(elapsed, 1e-3):.0f} rows/s)')
 
-if __name__ == '__main__':
+
+def run():
     logging.basicConfig(level=logging.INFO)
-    log = logging.getLogger('plot_sql')
 
-    parser = argparse.ArgumentParser(description="Plot readings from a SQL database")
+    parser = argparse.ArgumentParser(description="Export readings from a SQL database to Influxdb")
     parser.add_argument(nargs="+", dest="series", metavar="SERIES", help="Data series")
     parser.add_argument("--db", metavar="FILE", default="samples.sqlite", help="SQLite database file")
-    parser.add_argument("--time", metavar="SECONDS", type=int, default=24*60*60, help="Time span to export, in seconds")
+    parser.add_argument("--time", metavar="SECONDS", type=int, default=24*60*60,
+                        help="Time span to export, in seconds, when there is no checkpoint")
+    parser.add_argument("--resolution", metavar="SECONDS", type=int, choices=sample_db.ROLLUP_RESOLUTIONS,
+                        help="Export averages at this resolution instead of the raw samples")
+    parser.add_argument("--checkpoint", metavar="FILE",
+                        help="Remember the last exported sample of each series in FILE, and "
+                        "only export newer samples on the next run")
+    parser.add_argument("--jobs", metavar="N", type=int, default=4, help="Number of series exported at once")
     parser.add_argument("--url", metavar="URL", default="http://localhost:8086", help="Influxdb URL")
     parser.add_argument("--bucket", metavar="BUCKET",  help="Bucket name", required=True)
     parser.add_argument("--org", metavar="ORG",  help="Organization name", required=True)
     parser.add_argument("--token", metavar="TOKEN",  help="Influxdb access token", required=True)
     parser.add_argument("--debug", default=False, action="store_true", help="Enable debug printouts")
     args = parser.parse_args()
-    
+
     if args.debug:
         logging.getLogger().setLevel('DEBUG')
 
     export(args)
+
+
+if __name__ == '__main__':
+    run()
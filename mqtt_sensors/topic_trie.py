@@ -0,0 +1,59 @@
+from typing import Any, Dict, Iterator, List, Tuple
+
+
+class TopicNode:
+    __slots__ = ('children', 'values')
+
+    def __init__(self):
+        self.children: Dict[str, TopicNode] = {}
+        self.values: List[Any] = []
+
+
+class TopicTrie:
+    """Index of MQTT topic filters, one trie level per topic level.
+
+    Matching a topic walks the trie level by level, following the literal level as well as
+    any '+' and '#' branches, so the cost depends on the topic depth rather than on the
+    number of filters."""
+    def __init__(self):
+        self.root = TopicNode()
+        self._filters: List[str] = []
+
+    def add(self, topic_filter: str, value: Any):
+        node = self.root
+        for level in topic_filter.split('/'):
+            node = node.children.setdefault(level, TopicNode())
+        node.values.append(value)
+        if topic_filter not in self._filters:
+            self._filters.append(topic_filter)
+
+    def filters(self) -> List[str]:
+        return list(self._filters)
+
+    def match(self, topic: str) -> Iterator[Tuple[Any, List[str]]]:
+        """Yield the value of every filter matching the topic, with the topic levels
+        matched by wildcards"""
+        levels = topic.split('/')
+        # Wildcards don't match topics starting with '$', like $SYS
+        wildcards = not topic.startswith('$')
+        yield from self._match(self.root, levels, 0, [], wildcards)
+
+    def _match(self, node: TopicNode, levels: List[str], depth: int, captured: List[str],
+               wildcards: bool) -> Iterator[Tuple[Any, List[str]]]:
+        if wildcards:
+            # '#' also matches the parent level, so 'a/#' matches 'a'
+            multi = node.children.get('#')
+            if multi is not None:
+                for value in multi.values:
+                    yield value, captured + ['/'.join(levels[depth:])]
+        if depth == len(levels):
+            for value in node.values:
+                yield value, captured
+            return
+        child = node.children.get(levels[depth])
+        if child is not None:
+            yield from self._match(child, levels, depth + 1, captured, True)
+        if wildcards:
+            child = node.children.get('+')
+            if child is not None:
+                yield from self._match(child, levels, depth + 1, captured + [levels[depth]], True)
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+#
+# Benchmark the per-message path of mqtt_to_sql: JSON decoding and field extraction, and
+# writing the resulting samples to a scratch database
+#
+
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from mqtt_sensors import mqtt_to_sql
+
+
+class QueueCounter:
+    """Takes the place of the writer queue, keeping the samples for the write benchmark"""
+    def __init__(self):
+        self.samples = []
+
+    def put(self, timestamp, source_name, value):
+        self.samples.append((timestamp, source_name, value))
+
+
+def make_payloads(count: int, nodes: int):
+    start = int(time.time()) - count
+    return [(f'node{i % nodes}', json.dumps({
+        'time': start + i,
+        'temperature': 21.5 + i % 10 / 10,
+        'humidity': 45.2,
+        'linkquality': 120,
+        'voltage': 3000,
+        'battery': 100,
+        'update': {'state': 'idle'},
+    }).encode()) for i in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark mqtt_to_sql message handling")
+    parser.add_argument("--messages", metavar="N", type=int, default=100000)
+    parser.add_argument("--nodes", metavar="N", type=int, default=50)
+    parser.add_argument("--commit-size", metavar="N", type=int, default=1000)
+    args = parser.parse_args()
+
+    payloads = make_payloads(args.messages, args.nodes)
+    print(f'JSON decoder: {mqtt_to_sql.json_loads.__module__}')
+
+    counter = QueueCounter()
+    mqtt_to_sql.writer = counter
+    start = time.perf_counter()
+    for node_name, payload in payloads:
+        mqtt_to_sql.handle_json_topic(node_name, payload)
+    elapsed = time.perf_counter() - start
+    print(f'handle_json_topic: {args.messages / elapsed:.0f} messages/s, '
+          f'{elapsed / args.messages * 1e6:.2f} us/message, {len(counter.samples)} samples')
+
+    with tempfile.TemporaryDirectory() as directory:
+        writer = mqtt_to_sql.SampleWriter(os.path.join(directory, 'samples.sqlite'), args.commit_size, 1.0)
+        start = time.perf_counter()
+        for i in range(0, len(counter.samples), args.commit_size):
+            writer.write(counter.samples[i:i + args.commit_size])
+        elapsed = time.perf_counter() - start
+        writer.db.close()
+    print(f'SampleWriter.write: {len(counter.samples) / elapsed:.0f} samples/s')
+
+
+if __name__ == '__main__':
+    main()
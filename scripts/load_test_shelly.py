@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+#
+# Load test for the HTTP server of mqtt_shelly: many simulated Shelly H&T devices reporting at
+# the same time, some of them over keep-alive connections, and optionally some stalled clients
+# that connect and never send a request
+#
+
+import argparse
+import http.client
+import random
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+
+
+def device(host: str, port: int, index: int, reports: int, keep_alive: bool,
+           timeout: float) -> Tuple[List[float], int]:
+    """Send reports like a device waking up, returning the latency of each and the error count"""
+    latencies = []
+    errors = 0
+    conn = None
+    for _ in range(reports):
+        if conn is None:
+            conn = http.client.HTTPConnection(host, port, timeout=timeout)
+        temp = 20 + random.random() * 5
+        hum = 40 + random.random() * 20
+        start = time.monotonic()
+        try:
+            conn.request('GET', f'/?hum={hum:.1f}&temp={temp:.2f}&id=shellyht-load{index:04d}',
+                         headers={'User-Agent': 'load_test_shelly'})
+            response = conn.getresponse()
+            response.read()
+            if response.status != 200:
+                errors += 1
+            else:
+                latencies.append(time.monotonic() - start)
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            conn.close()
+            conn = None
+            continue
+        if not keep_alive:
+            conn.close()
+            conn = None
+    if conn is not None:
+        conn.close()
+    return latencies, errors
+
+
+def stall(host: str, port: int, stop: threading.Event):
+    """Connect and send half a request, then wait"""
+    with socket.create_connection((host, port)) as s:
+        s.sendall(b'GET /?hum=40')
+        stop.wait()
+
+
+def percentile(values: List[float], p: float) -> float:
+    return values[min(int(len(values) * p), len(values) - 1)] if values else float('nan')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the mqtt_shelly HTTP server")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=7123)
+    parser.add_argument("--devices", metavar="N", type=int, default=500, help="Number of simulated devices")
+    parser.add_argument("--reports", metavar="N", type=int, default=5, help="Reports sent by each device")
+    parser.add_argument("--keep-alive", default=False, action="store_true",
+                        help="Send the reports of a device over one connection")
+    parser.add_argument("--stalled", metavar="N", type=int, default=0,
+                        help="Number of clients that connect and stall for the whole test")
+    parser.add_argument("--timeout", metavar="SEC", type=float, default=30, help="Client timeout")
+    args = parser.parse_args()
+
+    stop = threading.Event()
+    stallers = [threading.Thread(target=stall, args=(args.host, args.port, stop), daemon=True)
+                for _ in range(args.stalled)]
+    for thread in stallers:
+        thread.start()
+    time.sleep(0.2)
+
+    start = time.monotonic()
+    # All devices wake up at once
+    with ThreadPoolExecutor(max_workers=args.devices) as executor:
+        results = list(executor.map(lambda i: device(args.host, args.port, i, args.reports,
+                                                     args.keep_alive, args.timeout),
+                                    range(args.devices)))
+    elapsed = time.monotonic() - start
+    stop.set()
+
+    latencies = sorted(latency for device_latencies, _ in results for latency in device_latencies)
+    errors = sum(device_errors for _, device_errors in results)
+    print(f'{len(latencies)} reports, {errors} errors in {elapsed:.2f} s '
+          f'({len(latencies) / elapsed:.0f} reports/s)')
+    print(f'Latency p50 {percentile(latencies, 0.5) * 1000:.1f} ms, '
+          f'p99 {percentile(latencies, 0.99) * 1000:.1f} ms, '
+          f'max {percentile(latencies, 1.0) * 1000:.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
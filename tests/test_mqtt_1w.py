@@ -0,0 +1,58 @@
+import logging
+
+import pytest
+
+from mqtt_sensors import mqtt_1w
+
+
+def make_sensor(tmp_path, name='28-0000075e1a2b') -> mqtt_1w.Sensor:
+    """A sensor directory like the w1_therm driver's, with its attributes as plain files"""
+    s_dir = tmp_path / name
+    s_dir.mkdir()
+    (s_dir / 'w1_slave').write_text('4b 01 4b 46 7f ff 05 10 e1 : crc=e1 YES\n'
+                                    '4b 01 4b 46 7f ff 05 10 e1 t=20687\n')
+    for attribute in ('resolution', 'conv_time'):
+        (s_dir / attribute).write_text('')
+    return mqtt_1w.Sensor(s_dir / 'w1_slave')
+
+
+def test_parse_sensor_settings():
+    assert mqtt_1w.parse_sensor_settings(None) == {}
+    assert mqtt_1w.parse_sensor_settings(['10', '28-0000075e1a2b=12', '28-00000a1b2c3d=9']) == \
+        {None: 10, '28-0000075e1a2b': 12, '28-00000a1b2c3d': 9}
+    # The last one wins
+    assert mqtt_1w.parse_sensor_settings(['10', '11']) == {None: 11}
+    with pytest.raises(ValueError):
+        mqtt_1w.parse_sensor_settings(['28-0000075e1a2b=high'])
+
+
+def test_configure_sensor(tmp_path, monkeypatch):
+    sensor = make_sensor(tmp_path)
+    other = make_sensor(tmp_path, '28-00000a1b2c3d')
+    written = []
+    write_sensor_attribute = mqtt_1w.write_sensor_attribute
+    monkeypatch.setattr(mqtt_1w, 'write_sensor_attribute',
+                        lambda s_dir, name, value: written.append((s_dir.name, name)) or
+                        write_sensor_attribute(s_dir, name, value))
+    resolutions = mqtt_1w.parse_sensor_settings(['10', '28-0000075e1a2b=12'])
+    conv_times = mqtt_1w.parse_sensor_settings(['28-0000075e1a2b=1'])
+    mqtt_1w.configure_sensor(sensor, resolutions, conv_times)
+    mqtt_1w.configure_sensor(other, resolutions, conv_times)
+    # Writing the resolution resets the conversion time, so it goes second
+    assert written == [(sensor.name, 'resolution'), (sensor.name, 'conv_time'), (other.name, 'resolution')]
+    assert (sensor.path.parent / 'resolution').read_text() == '12\n'
+    assert (sensor.path.parent / 'conv_time').read_text() == '1\n'
+    assert (other.path.parent / 'resolution').read_text() == '10\n'
+    assert (other.path.parent / 'conv_time').read_text() == ''
+
+
+def test_configure_sensor_write_error(tmp_path, caplog):
+    sensor = make_sensor(tmp_path)
+    # Fails to open like an attribute that an older driver doesn't have
+    (sensor.path.parent / 'resolution').unlink()
+    (sensor.path.parent / 'resolution').mkdir()
+    with caplog.at_level(logging.WARNING, logger='mqtt_1w'):
+        mqtt_1w.configure_sensor(sensor, {None: 11}, {None: 750})
+    assert 'Unable to set resolution on sensor 28-0000075e1a2b' in caplog.text
+    # The other settings are still applied
+    assert (sensor.path.parent / 'conv_time').read_text() == '750\n'
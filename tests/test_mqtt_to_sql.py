@@ -0,0 +1,29 @@
+import time
+
+from mqtt_sensors import mqtt_to_sql
+
+
+def rollup(writer, resolution=60):
+    return writer.db.execute(f'SELECT time, min, max, sum, count FROM rollup_{resolution} '
+                             'ORDER BY time').fetchall()
+
+
+def test_replaced_samples_are_not_counted_again(tmp_path):
+    writer = mqtt_to_sql.SampleWriter(str(tmp_path / 'samples.sqlite'), 1000, 1.0)
+    writer.write([(1700000000, 'test', 1.0), (1700000010, 'test', 2.0)])
+    writer.write([(1700000010, 'test', 3.0), (1700000020, 'test', 4.0), (1700000020, 'test', 5.0)])
+    assert writer.db.execute('SELECT time, value FROM samples ORDER BY time').fetchall() == \
+        [(1700000000, 1.0), (1700000010, 3.0), (1700000020, 5.0)]
+    # The first values of each sample, once each
+    assert rollup(writer) == [(1699999980, 1.0, 4.0, 7.0, 3)]
+
+
+def test_samples_for_cold_partitions_are_not_counted(tmp_path):
+    writer = mqtt_to_sql.SampleWriter(str(tmp_path / 'samples.sqlite'), 1000, 1.0,
+                                      partitions=('day', 7 * 24 * 60 * 60, None))
+    now = int(time.time()) // 60 * 60
+    cold = now - 30 * 24 * 60 * 60
+    writer.write([(cold, 'test', 1.0), (now, 'test', 2.0), (now + 1, 'test', 3.0)])
+    writer.write([(now + 1, 'test', 4.0)])
+    assert rollup(writer) == [(now, 2.0, 3.0, 5.0, 2)]
+    assert rollup(writer, 24 * 60 * 60)[0][4] == 2
@@ -0,0 +1,59 @@
+import socket
+import threading
+
+from mqtt_sensors import rrd_backend
+
+
+class FakeRrdCached:
+    """Answers BATCH requests on a UNIX socket like rrdcached, failing the updates of files
+    whose names contain "bad", and records the commands it gets"""
+    def __init__(self, path: str):
+        self.commands = []
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(1)
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        conn, _ = self.server.accept()
+        with conn, conn.makefile('rw', encoding='utf-8', newline='\n') as f:
+            for line in f:
+                if line == 'BATCH\n':
+                    f.write("0 Go ahead.  End with dot '.' on its own line.\n")
+                    f.flush()
+                    batch = []
+                    for line in f:
+                        if line == '.\n':
+                            break
+                        batch.append(line.rstrip('\n'))
+                    self.commands += batch
+                    errors = [f'{i} No such file: {command.split()[1]}'
+                              for i, command in enumerate(batch, 1) if 'bad' in command]
+                    f.write(f'{len(errors)} errors\n' + ''.join(f'{error}\n' for error in errors))
+                    f.flush()
+
+    def close(self):
+        self.server.close()
+
+
+def test_updates_are_sent_with_absolute_paths(tmp_path, monkeypatch):
+    daemon = FakeRrdCached(str(tmp_path / 'rrdcached.sock'))
+    monkeypatch.chdir(tmp_path)
+    backend = rrd_backend.RrdCached(f'unix:{tmp_path / "rrdcached.sock"}')
+    try:
+        failed = backend.update({
+            'living.rrd': ['1700000000:21.500000', '1700000060:21.600000'],
+            'rrd/bad.rrd': ['1700000000:U'],
+            str(tmp_path / 'outside.rrd'): ['1700000000:1.000000'],
+        })
+    finally:
+        backend.stop()
+        daemon.close()
+    assert daemon.commands == [
+        f'UPDATE {tmp_path / "living.rrd"} 1700000000:21.500000 1700000060:21.600000',
+        f'UPDATE {tmp_path / "rrd" / "bad.rrd"} 1700000000:U',
+        f'UPDATE {tmp_path / "outside.rrd"} 1700000000:1.000000',
+    ]
+    # Failed files are reported by the names they were given in
+    assert failed == ['rrd/bad.rrd']
@@ -0,0 +1,36 @@
+import sqlite3
+
+import numpy as np
+
+from mqtt_sensors import sample_blocks, sample_db
+
+
+def make_samples(count=10000, seed=1):
+    rng = np.random.default_rng(seed)
+    times = 1700000000 + np.cumsum(rng.integers(1, 120, count))
+    values = 20 + np.cumsum(rng.normal(0, 0.1, count))
+    values[::97] = -values[::97] * 1e-9
+    values[::101] = np.nan
+    return times.astype(np.int64), values
+
+
+def test_round_trip_is_exact():
+    times, values = make_samples()
+    decoded_times, decoded_values = sample_blocks.decode(*sample_blocks.encode(times, values), len(times))
+    assert np.array_equal(decoded_times, times)
+    assert np.array_equal(decoded_values.view('<u8'), values.view('<u8'))
+
+
+def test_compacted_samples_are_exact():
+    db = sqlite3.connect(':memory:')
+    sample_db.create_schema(db)
+    db.execute("INSERT INTO series (name) VALUES ('test')")
+    times, values = make_samples(seed=2)
+    db.executemany('INSERT INTO samples (time, series, value) VALUES (?, 1, ?)',
+                   zip(times.tolist(), values.tolist()))
+    while sample_db.compact_block(db, 'main', 1, int(times[-1]) + 1):
+        pass
+    assert db.execute('SELECT count(*) FROM samples').fetchone()[0] == 0
+    read_times, read_values = sample_db.read_range(db, 1, int(times[0]), int(times[-1]))
+    assert np.array_equal(read_times, times)
+    assert np.array_equal(read_values.view('<u8'), values.view('<u8'))
@@ -0,0 +1,94 @@
+import gzip
+import sqlite3
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from mqtt_sensors import sample_db, sql_to_influxdb
+from mqtt_sensors.checkpoint import Checkpoint
+from mqtt_sensors.influx import InfluxWriter
+
+
+class FakeInflux(BaseHTTPRequestHandler):
+    """Write endpoint that answers with the queued status codes, then with 204, and keeps
+    the lines of the requests it accepts"""
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        server.requests.append((self.path, self.headers['Content-Encoding'], self.headers['Authorization']))
+        status = server.statuses.pop(0) if server.statuses else 204
+        if status == 204:
+            server.lines += gzip.decompress(body).decode().split('\n')
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def influx():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeInflux)
+    server.requests = []
+    server.statuses = []
+    server.lines = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def db_file(tmp_path):
+    path = str(tmp_path / 'samples.sqlite')
+    db = sqlite3.connect(path)
+    sample_db.create_schema(db)
+    db.execute("INSERT INTO series (id, name) VALUES (1, 'living room-t')")
+    db.executemany('INSERT INTO samples (time, series, value) VALUES (?, 1, ?)',
+                   [(1700000040 + i * 60, 20 + i / 4) for i in range(10)])
+    db.commit()
+    db.close()
+    return path
+
+
+def test_export_series(influx, db_file, tmp_path, monkeypatch):
+    monkeypatch.setattr(sql_to_influxdb, 'RETRY_DELAY', 0.01)
+    writer = InfluxWriter(f'http://127.0.0.1:{influx.server_port}', 'home', 'sensors', 'secret')
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoint.json'))
+    # Server errors are retried
+    influx.statuses = [503, 500]
+    count = sql_to_influxdb.export_series(db_file, writer, checkpoint, 'living room-t', 1699990000, 1700001000)
+    assert count == 10
+    assert len(influx.requests) == 3
+    path, encoding, authorization = influx.requests[-1]
+    assert path == '/api/v2/write?org=home&bucket=sensors&precision=s'
+    assert encoding == 'gzip'
+    assert authorization == 'Token secret'
+    assert influx.lines == [f'sample,series=living\\ room-t living\\ room-t={20 + i / 4!r} {1700000040 + i * 60}'
+                            for i in range(10)]
+    assert Checkpoint(str(tmp_path / 'checkpoint.json')).get('living room-t/raw') == 1700000580
+
+    # The next run only sends what is newer than the checkpoint
+    db = sqlite3.connect(db_file)
+    db.execute('INSERT INTO samples (time, series, value) VALUES (1700000640, 1, 30.0)')
+    db.commit()
+    db.close()
+    influx.lines = []
+    count = sql_to_influxdb.export_series(db_file, writer, checkpoint, 'living room-t', 1699990000, 1700001000)
+    assert count == 1
+    assert influx.lines == ['sample,series=living\\ room-t living\\ room-t=30.0 1700000640']
+    assert checkpoint.get('living room-t/raw') == 1700000640
+
+
+def test_rejected_writes_are_not_retried(influx, db_file, tmp_path, monkeypatch):
+    monkeypatch.setattr(sql_to_influxdb, 'RETRY_DELAY', 0.01)
+    writer = InfluxWriter(f'http://127.0.0.1:{influx.server_port}', 'home', 'sensors', 'secret')
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoint.json'))
+    influx.statuses = [400]
+    with pytest.raises(sql_to_influxdb.urllib.error.HTTPError):
+        sql_to_influxdb.export_series(db_file, writer, checkpoint, 'living room-t', 1699990000, 1700001000)
+    assert len(influx.requests) == 1
+    assert checkpoint.get('living room-t/raw') is None